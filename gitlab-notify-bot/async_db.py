@@ -0,0 +1,136 @@
+import asyncio
+import functools
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+from db import Database
+
+
+class AsyncDatabase:
+    """
+    Асинхронный фасад над Database с тем же набором методов.
+    Вызовы psycopg2 выполняются в ограниченном пуле потоков, поэтому
+    обработчики aiogram и мониторы не блокируют цикл событий на запросах к БД.
+    """
+
+    def __init__(self, database: Database, max_workers: int | None = None):
+        self.database = database
+        # Потоков не больше, чем соединений в пуле: лишние потоки всё равно ждали бы слот
+        self.max_workers = max_workers or database.maxconn
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="db")
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Выполняет синхронную функцию в пуле потоков БД
+        :param func: функция, например лямбда с несколькими вызовами Database в одном with database.connection()
+        :return: результат функции
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self.database, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        # Кэшируем обёртку, чтобы не создавать её при каждом обращении
+        setattr(self, name, method)
+        return method
+
+    def close(self):
+        """Дожидается завершения запросов и закрывает пул соединений."""
+        self._executor.shutdown(wait=True)
+        self.database.close()
+        logging.info("Асинхронный доступ к БД остановлен")
+
+
+class DatabaseListener:
+    """
+    Подписка на каналы Postgres LISTEN/NOTIFY без опроса: сокет отдельного соединения
+    регистрируется в цикле событий, и уведомления разбираются только когда пришли данные.
+    """
+
+    def __init__(self, database: Database, channels: list[str]):
+        self.database = database
+        self.channels = channels
+        self._conn = None
+        # Дескриптор сокета запоминается при подключении: у закрытого сервером соединения fileno() бросает ошибку
+        self._fd: int | None = None
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._conn = await loop.run_in_executor(None, self.database.dedicated_connection)
+        with self._conn.cursor() as cur:
+            for channel in self.channels:
+                cur.execute(f'LISTEN "{channel}"')
+        self._fd = self._conn.fileno()
+        loop.add_reader(self._fd, self._on_readable)
+        logging.info(f"Подписка на каналы БД {self.channels} установлена")
+
+    def _on_readable(self):
+        try:
+            self._conn.poll()
+        except psycopg2.Error as e:
+            logging.warning(f"Соединение LISTEN потеряно: {e}")
+            self._drop()
+            # Пробуждаем ожидающих, чтобы они переподключились
+            self._queue.put_nowait(None)
+            return
+        while self._conn.notifies:
+            notify = self._conn.notifies.pop(0)
+            try:
+                payload = json.loads(notify.payload)
+            except ValueError:
+                payload = {"raw": notify.payload}
+            self._queue.put_nowait((notify.channel, payload))
+
+    def _drop(self):
+        if self._conn is None:
+            return
+        try:
+            if self._fd is not None:
+                asyncio.get_running_loop().remove_reader(self._fd)
+        except (ValueError, OSError, RuntimeError):
+            pass
+        finally:
+            conn, self._conn, self._fd = self._conn, None, None
+            # Следующий wait() переподключится, даже если закрыть старое соединение не удалось
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    async def wait(self, timeout: float) -> list[tuple[str, dict]]:
+        """
+        Ждёт уведомлений не дольше timeout секунд
+        :return: список пар (канал, данные события); пустой список - если истёк таймаут
+        """
+        deadline = time.monotonic() + timeout
+        if self._conn is None:
+            try:
+                await self.start()
+            except psycopg2.Error as e:
+                logging.warning(f"Не удалось подписаться на каналы БД, ждём без уведомлений: {e}")
+                await asyncio.sleep(timeout)
+                return []
+
+        try:
+            first = await asyncio.wait_for(self._queue.get(), timeout=max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            return []
+        events = [first]
+        while not self._queue.empty():
+            events.append(self._queue.get_nowait())
+        return [event for event in events if event is not None]
+
+    def close(self):
+        self._drop()
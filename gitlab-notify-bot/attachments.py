@@ -0,0 +1,270 @@
+import asyncio
+import logging
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import AsyncGenerator
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InputFile, InputMediaPhoto, InputMediaDocument, Message
+from dotenv import load_dotenv
+
+from async_db import AsyncDatabase
+from blob_store import BlobStore
+from gitlab_client import GitLabClient
+
+load_dotenv()
+ATTACHMENT_CONFIG = {
+    # Файлы меньше порога держатся в памяти, крупнее - переносятся во временный файл на диске
+    "spool_threshold": int(os.getenv("ATTACHMENT_SPOOL_THRESHOLD", str(1024 * 1024))),
+    # Лимит Telegram на загрузку файла ботом
+    "max_bytes": int(os.getenv("ATTACHMENT_MAX_BYTES", str(50 * 1024 * 1024))),
+    "chunk_size": int(os.getenv("ATTACHMENT_CHUNK_SIZE", str(64 * 1024))),
+    "upload_concurrency": int(os.getenv("GITLAB_UPLOAD_CONCURRENCY", "4")),
+    "upload_retries": int(os.getenv("GITLAB_UPLOAD_RETRIES", "2")),
+}
+
+MEDIA_PHOTO = "photo"
+MEDIA_DOCUMENT = "document"
+
+
+class SpooledInputFile(InputFile):
+    """
+    Файл для загрузки в Telegram, читаемый частями из SpooledTemporaryFile.
+    Каждое чтение ведёт свою позицию, поэтому один файл можно одновременно отправлять нескольким получателям.
+    """
+
+    def __init__(self, file, filename: str, chunk_size: int = ATTACHMENT_CONFIG['chunk_size']):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        position = 0
+        while True:
+            self.file.seek(position)
+            chunk = self.file.read(self.chunk_size)
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+
+
+@dataclass
+class PreparedAttachment:
+    """Вложение GitLab, готовое к отправке: либо уже известный file_id Telegram, либо файл для загрузки."""
+    project_id: int
+    label: str
+    path: str
+    media_type: str
+    file_id: str | None = None
+    content: tempfile.SpooledTemporaryFile | None = None
+    content_hash: str | None = None
+
+    @property
+    def filename(self) -> str:
+        return self.label or os.path.basename(self.path).lstrip("_")
+
+    def input_file(self):
+        return self.file_id or SpooledInputFile(self.content, filename=self.filename)
+
+    def close(self):
+        """Освобождает временный файл с содержимым вложения."""
+        if self.content is not None:
+            self.content.close()
+            self.content = None
+
+
+def sent_file_id(message: Message) -> str | None:
+    if message.photo:
+        return message.photo[-1].file_id
+    if message.document:
+        return message.document.file_id
+    return None
+
+
+class AttachmentRelay:
+    """
+    Пересылка вложений GitLab в Telegram с постоянным кэшем file_id.
+    Файл скачивается из GitLab и загружается в Telegram только при первой отправке,
+    дальше любой чат получает его по file_id из таблицы telegram_file_cache.
+    """
+
+    def __init__(self, gitlab: GitLabClient, db: AsyncDatabase,
+                 spool_threshold: int = ATTACHMENT_CONFIG['spool_threshold'],
+                 max_bytes: int = ATTACHMENT_CONFIG['max_bytes']):
+        self.gitlab = gitlab
+        self.db = db
+        self.spool_threshold = spool_threshold
+        self.max_bytes = max_bytes
+
+    async def prepare(self, project_id: int, label: str, path: str, media_type: str | None = None,
+                      use_cache: bool = True) -> PreparedAttachment | None:
+        """
+        :param media_type: photo или document; None - определить по Content-Type
+        :return: подготовленное вложение или None, если скачать его не удалось
+        """
+        if use_cache:
+            for candidate in ([media_type] if media_type else [MEDIA_PHOTO, MEDIA_DOCUMENT]):
+                file_id = await self.db.get_telegram_file_id(project_id, path, candidate)
+                if file_id:
+                    return PreparedAttachment(project_id, label, path, candidate, file_id=file_id)
+
+        # Вложение скачивается потоком: в памяти остаётся не больше spool_threshold байт на файл
+        content = tempfile.SpooledTemporaryFile(max_size=self.spool_threshold)
+        downloaded = await self.gitlab.stream_download(path, content, max_bytes=self.max_bytes)
+        if not downloaded:
+            content.close()
+            return None
+        content_type, _, content_hash = downloaded
+        if media_type is None:
+            media_type = MEDIA_PHOTO if content_type.startswith("image/") else MEDIA_DOCUMENT
+        item = PreparedAttachment(project_id, label, path, media_type, content=content, content_hash=content_hash)
+        if use_cache:
+            # Тот же файл мог быть загружен под другим путём
+            item.file_id = await self.db.get_telegram_file_id_by_hash(item.content_hash, media_type)
+            if item.file_id:
+                item.close()
+                await self.db.save_telegram_file_id(project_id, path, media_type, item.content_hash, item.file_id)
+        return item
+
+    async def remember(self, item: PreparedAttachment, message: Message):
+        """
+        Сохраняет file_id, выданный Telegram при первой загрузке файла.
+        Содержимое не закрывается: его ещё могут читать параллельные отправки, файл освобождает release()
+        """
+        if item.file_id or item.content_hash is None:
+            return
+        file_id = sent_file_id(message)
+        if file_id:
+            item.file_id = file_id
+            await self.db.save_telegram_file_id(item.project_id, item.path, item.media_type,
+                                                item.content_hash, file_id)
+
+    async def prepare_many(self, project_id: int, attachments: list[tuple[str, str]],
+                           use_cache: bool = True) -> list[PreparedAttachment]:
+        prepared = []
+        for label, path in attachments:
+            item = await self.prepare(project_id, label, path, use_cache=use_cache)
+            if item:
+                prepared.append(item)
+        return prepared
+
+    @staticmethod
+    def release(prepared: list[PreparedAttachment]):
+        for item in prepared:
+            item.close()
+
+    @staticmethod
+    def build_media_group(prepared: list[PreparedAttachment], caption: str) -> list:
+        media = []
+        for idx, item in enumerate(prepared):
+            media_cls = InputMediaPhoto if item.media_type == MEDIA_PHOTO else InputMediaDocument
+            media.append(media_cls(media=item.input_file(),
+                                   caption=caption if idx == 0 else item.filename,
+                                   parse_mode="HTML"))
+        return media
+
+    async def send_media_group(self, bot: Bot, chat_id, prepared: list[PreparedAttachment], caption: str):
+        """
+        Отправляет альбом и запоминает file_id загруженных файлов.
+        Если Telegram отверг закэшированный file_id, файлы скачиваются и загружаются заново.
+        Список prepared не меняется, поэтому его можно одновременно отправлять нескольким получателям.
+        """
+        items = list(prepared)
+        redownloaded = []
+        try:
+            try:
+                messages = await bot.send_media_group(chat_id, self.build_media_group(items, caption))
+            except TelegramBadRequest as e:
+                if not any(item.content is None for item in items):
+                    raise
+                logging.warning(f"Telegram отклонил закэшированные file_id, загружаем вложения заново: {e}")
+                # Уже скачанные файлы переиспользуются, заново скачиваются только вложения с file_id
+                for idx, item in enumerate(items):
+                    if item.content is not None:
+                        continue
+                    fresh = await self.prepare(item.project_id, item.label, item.path, item.media_type,
+                                               use_cache=False)
+                    if fresh is not None:
+                        redownloaded.append(fresh)
+                        items[idx] = fresh
+                messages = await bot.send_media_group(chat_id, self.build_media_group(items, caption))
+            for item, message in zip(items, messages):
+                await self.remember(item, message)
+            return messages
+        finally:
+            # Заново скачанные файлы принадлежат только этой отправке
+            self.release(redownloaded)
+
+    async def send_document(self, message: Message, project_id: int, label: str, path: str) -> bool:
+        """
+        Отправляет вложение документом в ответ на сообщение
+        :return: False, если вложение не удалось получить
+        """
+        item = await self.prepare(project_id, label, path, MEDIA_DOCUMENT)
+        if item is None:
+            return False
+        try:
+            try:
+                sent = await message.answer_document(document=item.input_file(), caption=label)
+            except TelegramBadRequest as e:
+                if item.content is not None:
+                    raise
+                logging.warning(f"Telegram отклонил закэшированный file_id {path}, загружаем заново: {e}")
+                item = await self.prepare(project_id, label, path, MEDIA_DOCUMENT, use_cache=False)
+                if item is None:
+                    return False
+                sent = await message.answer_document(document=item.input_file(), caption=label)
+            await self.remember(item, sent)
+            return True
+        finally:
+            if item is not None:
+                item.close()
+
+
+class GitLabUploader:
+    """
+    Загрузка файлов пользователя из BlobStore в GitLab.
+    Все файлы одного сообщения загружаются одновременно (не больше concurrency на весь бот),
+    неудачная загрузка повторяется до retries раз.
+    """
+
+    def __init__(self, gitlab: GitLabClient, blobs: BlobStore,
+                 concurrency: int = ATTACHMENT_CONFIG['upload_concurrency'],
+                 retries: int = ATTACHMENT_CONFIG['upload_retries']):
+        self.gitlab = gitlab
+        self.blobs = blobs
+        self.retries = retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def upload(self, project_id: int, f: dict) -> dict | None:
+        """
+        :param f: описание файла из данных FSM {'file_name', 'blob', 'size', 'mime_type'}
+        :return: ответ GitLab или None, если файл так и не загрузился
+        """
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(attempt)
+            # Каждая попытка читает файл с начала
+            fh = self.blobs.open(f['blob'])
+            if fh is None:
+                logging.warning(f"Файл {f['file_name']} уже удалён из хранилища")
+                return None
+            with fh:
+                async with self._semaphore:
+                    uploaded = await self.gitlab.upload_file(project_id, f['file_name'], fh, f['mime_type'])
+            if uploaded:
+                return uploaded
+            logging.warning(f"Не удалось загрузить {f['file_name']} в проект {project_id}, попытка {attempt + 1}")
+        return None
+
+    async def upload_all(self, project_id: int, files: list[dict]) -> list[dict | None]:
+        """
+        :return: ответы GitLab в порядке files, None на месте незагруженных файлов
+        """
+        return list(await asyncio.gather(*(self.upload(project_id, f) for f in files)))
+
+
+def uploaded_markdown(uploads: list[dict | None]) -> list[str]:
+    return [upload['markdown'] for upload in uploads if upload]
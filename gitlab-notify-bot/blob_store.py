@@ -0,0 +1,277 @@
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Any, Hashable
+
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from dotenv import load_dotenv
+
+load_dotenv()
+BLOB_STORE_CONFIG = {
+    "directory": os.getenv("BLOB_STORE_DIR", os.path.join(tempfile.gettempdir(), "gitlab-notify-bot-blobs")),
+    "max_bytes": int(os.getenv("BLOB_STORE_MAX_BYTES", str(512 * 1024 * 1024))),
+    "session_ttl": float(os.getenv("BLOB_SESSION_TTL", str(6 * 3600))),
+}
+# Ключ ссылки на файл в данных FSM: {'file_name': ..., 'blob': <sha256>, 'size': ..., 'mime_type': ...}
+BLOB_REF_KEY = "blob"
+
+
+def blob_refs(data: Any) -> set[str]:
+    """
+    :param data: данные FSM
+    :return: хэши всех файлов, на которые ссылаются данные
+    """
+    found = set()
+    if isinstance(data, dict):
+        ref = data.get(BLOB_REF_KEY)
+        if isinstance(ref, str):
+            found.add(ref)
+        for value in data.values():
+            if isinstance(value, (dict, list)):
+                found |= blob_refs(value)
+    elif isinstance(data, list):
+        for value in data:
+            found |= blob_refs(value)
+    return found
+
+
+@dataclass
+class _Blob:
+    size: int
+    sessions: set = field(default_factory=set)
+
+
+@dataclass
+class _Session:
+    blobs: set = field(default_factory=set)
+    # Файлы, уже сохранённые, но ещё не записанные обработчиком в данные сессии
+    pending: set = field(default_factory=set)
+    touched: float = field(default_factory=time.monotonic)
+
+
+class BlobWriter:
+    """Временный файл в каталоге хранилища, считающий sha256 и размер по мере записи."""
+
+    def __init__(self, directory: str):
+        self.file = tempfile.NamedTemporaryFile(dir=directory, prefix=".incoming-", delete=False)
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes) -> int:
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        return self.file.write(chunk)
+
+    def flush(self):
+        self.file.flush()
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.file.name)
+        except FileNotFoundError:
+            pass
+
+
+class BlobStore:
+    """
+    Файлы, которые пользователи присылают боту, на диске вместо данных FSM.
+    Файлы адресуются хэшем содержимого, одинаковые файлы хранятся один раз.
+    Файл живёт, пока на него ссылается хотя бы одна сессия; сессии, неактивные дольше session_ttl,
+    и самые давние сессии при превышении max_bytes освобождают свои файлы.
+    Только что сохранённый файл считается ожидающим, пока ссылка на него не появится в данных сессии:
+    параллельный обработчик, записавший данные без этой ссылки, его не освобождает.
+    """
+
+    def __init__(self, directory: str = BLOB_STORE_CONFIG['directory'],
+                 max_bytes: int = BLOB_STORE_CONFIG['max_bytes'],
+                 session_ttl: float = BLOB_STORE_CONFIG['session_ttl']):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.session_ttl = session_ttl
+        self.total_bytes = 0
+        self._blobs: dict[str, _Blob] = {}
+        self._sessions: dict[Hashable, _Session] = {}
+        # Файлы прошлого запуска: сессии FSM переживают перезапуск, поэтому файлы ждут,
+        # пока их снова не упомянут данные сессии, но не дольше session_ttl
+        self._orphans: dict[str, float] = {}
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if name.startswith(".incoming-"):
+                    os.remove(path)
+                    continue
+                self._blobs[name] = _Blob(size=os.path.getsize(path))
+            except OSError as e:
+                logging.warning(f"Не удалось проверить файл хранилища {name}: {e}")
+                continue
+            self.total_bytes += self._blobs[name].size
+            self._orphans[name] = time.monotonic()
+
+    def _path(self, blob_hash: str) -> str:
+        return os.path.join(self.directory, blob_hash)
+
+    def writer(self) -> BlobWriter:
+        return BlobWriter(self.directory)
+
+    def commit(self, session_key: Hashable, writer: BlobWriter) -> tuple[str, int]:
+        """
+        Переносит записанный файл в хранилище и привязывает его к сессии
+        :return: кортеж (sha256, размер)
+        """
+        writer.file.close()
+        blob_hash = writer.digest.hexdigest()
+        if blob_hash in self._blobs:
+            writer.abort()
+        else:
+            os.replace(writer.file.name, self._path(blob_hash))
+            self._blobs[blob_hash] = _Blob(size=writer.size)
+            self.total_bytes += writer.size
+        self._link(session_key, blob_hash)
+        self._sessions[session_key].pending.add(blob_hash)
+        self.expire()
+        self._evict(keep=session_key)
+        return blob_hash, writer.size
+
+    def open(self, blob_hash: str):
+        """
+        :return: файл, открытый на чтение, или None, если файл уже освобождён
+        """
+        if blob_hash not in self._blobs:
+            return None
+        try:
+            return open(self._path(blob_hash), "rb")
+        except FileNotFoundError:
+            return None
+
+    def _session(self, session_key: Hashable) -> _Session:
+        session = self._sessions.get(session_key)
+        if session is None:
+            session = self._sessions[session_key] = _Session()
+        session.touched = time.monotonic()
+        return session
+
+    def _link(self, session_key: Hashable, blob_hash: str):
+        self._orphans.pop(blob_hash, None)
+        self._session(session_key).blobs.add(blob_hash)
+        self._blobs[blob_hash].sessions.add(session_key)
+
+    def _drop(self, blob_hash: str):
+        blob = self._blobs.pop(blob_hash)
+        self._orphans.pop(blob_hash, None)
+        self.total_bytes -= blob.size
+        try:
+            os.remove(self._path(blob_hash))
+        except FileNotFoundError:
+            pass
+
+    def _unlink(self, session_key: Hashable, blob_hash: str):
+        blob = self._blobs.get(blob_hash)
+        if blob is None:
+            return
+        blob.sessions.discard(session_key)
+        if not blob.sessions and blob_hash not in self._orphans:
+            self._drop(blob_hash)
+
+    def touch(self, session_key: Hashable):
+        if session_key in self._sessions:
+            self._sessions[session_key].touched = time.monotonic()
+
+    def retain(self, session_key: Hashable, blob_hashes: set[str]):
+        """
+        Оставляет за сессией перечисленные файлы и ожидающие записи в данные, остальные освобождаются.
+        Ожидающий файл, попавший в blob_hashes, становится обычным.
+        """
+        session = self._sessions.get(session_key)
+        current = session.blobs if session else set()
+        pending = (session.pending - blob_hashes) if session else set()
+        for blob_hash in current - blob_hashes - pending:
+            self._unlink(session_key, blob_hash)
+        # Файлы, уже освобождённые по TTL или лимиту, вернуть нельзя
+        kept = {blob_hash for blob_hash in blob_hashes | pending if blob_hash in self._blobs}
+        if not kept:
+            self._sessions.pop(session_key, None)
+            return
+        session = self._session(session_key)
+        session.blobs = kept
+        session.pending = pending & kept
+        for blob_hash in kept:
+            self._orphans.pop(blob_hash, None)
+            self._blobs[blob_hash].sessions.add(session_key)
+
+    def discard(self, session_key: Hashable, blob_hash: str):
+        session = self._sessions.get(session_key)
+        if session is not None:
+            session.blobs.discard(blob_hash)
+            session.pending.discard(blob_hash)
+        self._unlink(session_key, blob_hash)
+
+    def release(self, session_key: Hashable):
+        session = self._sessions.pop(session_key, None)
+        if session is not None:
+            for blob_hash in session.blobs:
+                self._unlink(session_key, blob_hash)
+
+    def expire(self, now: float | None = None) -> int:
+        """
+        Освобождает файлы сессий, неактивных дольше session_ttl
+        :return: число освобождённых сессий
+        """
+        now = time.monotonic() if now is None else now
+        stale = [key for key, session in self._sessions.items() if now - session.touched > self.session_ttl]
+        for key in stale:
+            self.release(key)
+        for blob_hash in [h for h, since in self._orphans.items() if now - since > self.session_ttl]:
+            self._drop(blob_hash)
+        return len(stale)
+
+    def _evict(self, keep: Hashable | None = None):
+        for blob_hash in list(self._orphans):
+            if self.total_bytes <= self.max_bytes:
+                return
+            self._drop(blob_hash)
+        if self.total_bytes <= self.max_bytes:
+            return
+        for key in sorted(self._sessions, key=lambda k: self._sessions[k].touched):
+            if key == keep:
+                continue
+            logging.warning(f"Хранилище файлов переполнено ({self.total_bytes} байт), освобождаем сессию {key}")
+            self.release(key)
+            if self.total_bytes <= self.max_bytes:
+                break
+
+    def stats(self) -> dict:
+        return {"blobs": len(self._blobs), "sessions": len(self._sessions), "bytes": self.total_bytes}
+
+
+class BlobTrackingStorage(BaseStorage):
+    """
+    Обёртка над хранилищем FSM, которая сверяет ссылки сессии на файлы BlobStore при каждой записи данных.
+    state.clear() и любая перезапись данных без ссылки освобождают файлы сами.
+    """
+
+    def __init__(self, storage: BaseStorage, blobs: BlobStore):
+        self.storage = storage
+        self.blobs = blobs
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self.blobs.touch(key)
+        await self.storage.set_state(key, state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return await self.storage.get_state(key)
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        await self.storage.set_data(key, data)
+        self.blobs.retain(key, blob_refs(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        self.blobs.touch(key)
+        return await self.storage.get_data(key)
+
+    async def close(self) -> None:
+        await self.storage.close()
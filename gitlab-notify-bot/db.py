@@ -1,12 +1,20 @@
+import json
 import logging
 import datetime
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import psycopg2
-from psycopg2 import sql
+from psycopg2 import pool
+from psycopg2.extras import Json, execute_values
 
 import os
 from dotenv import load_dotenv
 
+from migrations import MIGRATIONS
+
 load_dotenv()
 DB_CONFIG = {
     "dbname": os.getenv("DB_NAME"),
@@ -16,116 +24,384 @@ DB_CONFIG = {
     "port": os.getenv("DB_PORT"),
     "table_name": os.getenv("DB_TABLE_NAME")
 }
+DB_POOL_CONFIG = {
+    "minconn": int(os.getenv("DB_POOL_MIN", "1")),
+    "maxconn": int(os.getenv("DB_POOL_MAX", "10")),
+    "health_check_interval": float(os.getenv("DB_POOL_HEALTH_CHECK_INTERVAL", "30")),
+}
+DB_USER_CACHE_CONFIG = {
+    # Сколько секунд запись пользователя (или её отсутствие) отдаётся без запроса к БД
+    "ttl": float(os.getenv("DB_USER_CACHE_TTL", "60")),
+    "max_entries": int(os.getenv("DB_USER_CACHE_MAX_ENTRIES", "1000")),
+}
+MIGRATIONS_LOCK_ID = 7_311_001
+# Каналы LISTEN/NOTIFY, в которые публикуются изменения отслеживаемых задач и подписок
+TRACKED_ISSUES_CHANNEL = 'tracked_issues'
+ISSUE_SUBSCRIPTIONS_CHANNEL = 'issue_subscriptions'
+# Частые запросы, которые готовятся на сервере один раз на соединение: имя -> текст с параметрами $n
+PREPARED_STATEMENTS = {
+    "user_by_telegram_id": "SELECT * FROM users WHERE telegram_id = $1",
+    "user_by_gitlab_id": "SELECT * FROM users WHERE gitlab_id = $1",
+    "issue_subscribers": "SELECT user_telegram_id FROM issue_subscriptions WHERE project_id = $1 AND issue_iid = $2",
+}
+
+
+class UserCache:
+    """
+    Ограниченный LRU-кэш записей users с TTL, ключ — (поле, значение), например ('gitlab_id', 42).
+    Отсутствие пользователя тоже кэшируется, чтобы авторы без Telegram не запрашивались на каждой заметке.
+    Методы Database выполняются в пуле потоков, поэтому доступ защищён блокировкой.
+    """
+
+    def __init__(self, ttl: float = DB_USER_CACHE_CONFIG['ttl'],
+                 max_entries: int = DB_USER_CACHE_CONFIG['max_entries']):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, tuple[float, dict | None]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def get(self, key: tuple):
+        """
+        :return: кортеж (найдено в кэше, запись пользователя или None)
+        """
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None or time.monotonic() - item[0] > self.ttl:
+                self._entries.pop(key, None)
+                self._stats["misses"] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return True, dict(item[1]) if item[1] is not None else None
+
+    def put(self, key: tuple, user: dict | None):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = (now, user)
+            self._entries.move_to_end(key)
+            # Найденную запись кладём и под вторым идентификатором
+            if user is not None:
+                for field in ('telegram_id', 'gitlab_id'):
+                    if field != key[0] and user.get(field) is not None:
+                        self._entries[(field, user[field])] = (now, user)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, **ids):
+        """Сбрасывает записи по переданным идентификаторам, например invalidate(telegram_id=1, gitlab_id=2)."""
+        with self._lock:
+            for field, value in ids.items():
+                item = self._entries.pop((field, value), None)
+                # Вместе с записью сбрасываем её копию под другим идентификатором
+                if item is not None and item[1] is not None:
+                    for other in ('telegram_id', 'gitlab_id'):
+                        self._entries.pop((other, item[1].get(other)), None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
 
 class Database:
-    def __init__(self, dbname, user, password, host, port):
+    def __init__(self, dbname, user, password, host, port,
+                 minconn=DB_POOL_CONFIG['minconn'],
+                 maxconn=DB_POOL_CONFIG['maxconn'],
+                 health_check_interval=DB_POOL_CONFIG['health_check_interval']):
         self.dbname = dbname
         self.user = user
         self.password = password
         self.host = host
         self.port = port
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.health_check_interval = health_check_interval
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # ThreadedConnectionPool при исчерпании бросает PoolError, поэтому ожидание
+        # свободного соединения реализуем семафором на maxconn слотов
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._local = threading.local()
+        self._last_used = {}
+        # id соединения -> имена подготовленных на нём запросов
+        self._prepared = {}
+        self.user_cache = UserCache()
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "health_checks": 0,
+            "discarded": 0,
+        }
+
+    def _get_pool(self):
+        """Лениво создаёт пул соединений при первом обращении."""
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = pool.ThreadedConnectionPool(
+                        self.minconn,
+                        self.maxconn,
+                        dbname=self.dbname,
+                        user=self.user,
+                        password=self.password,
+                        host=self.host,
+                        port=self.port
+                    )
+                    logging.info(f"Пул соединений с БД создан (min={self.minconn}, max={self.maxconn})")
+        return self._pool
+
+    def _is_healthy(self, conn):
+        """Проверяет соединение перед выдачей: закрытые отбрасываются, давно простаивающие пингуются."""
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.health_check_interval:
+            return True
+        self._stats["health_checks"] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logging.warning(f"Соединение с БД не прошло проверку: {e}")
+            return False
+
+    def _checkout(self):
+        started = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            self._stats["waits"] += 1
+            self._slots.acquire()
+            self._stats["wait_time"] += time.monotonic() - started
+        try:
+            db_pool = self._get_pool()
+            while True:
+                conn = db_pool.getconn()
+                if self._is_healthy(conn):
+                    break
+                self._stats["discarded"] += 1
+                self._forget(conn)
+                db_pool.putconn(conn, close=True)
+            self._stats["checkouts"] += 1
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _forget(self, conn):
+        self._last_used.pop(id(conn), None)
+        self._prepared.pop(id(conn), None)
 
-    def check_table_exists(self, table_name, schema='public'):
-        """Проверяет существование таблицы в указанной схеме."""
-        query = sql.SQL("""
-            SELECT EXISTS (
-                SELECT 1 
-                FROM information_schema.tables 
-                WHERE table_schema = %s 
-                AND table_name = %s
-            );
-        """)
-        with self.conn.cursor() as cur:
-            cur.execute(query, (schema, table_name))  # Учитываем регистр
-            return cur.fetchone()[0]
-
-    def create_users_table(self):
-        """Создаёт таблицу Users с необходимыми столбцами."""
-        query = sql.SQL("""
-            CREATE TABLE IF NOT EXISTS {table} (
-                telegram_id BIGINT PRIMARY KEY,
-                gitlab_id INTEGER NOT NULL,
-                gitlab_login TEXT NOT NULL,
-                gitlab_token TEXT NOT NULL,
-                telegram_chat_id BIGINT NOT NULL 
-            );
-        """).format(table=sql.Identifier('users'))
-
-        with self.conn.cursor() as cur:
-            cur.execute(query)
-        self.conn.commit()
-        logging.info(f"Таблица users создана")
-
-    def __enter__(self):
+    def _release(self, conn, broken=False):
         try:
-            self.conn = psycopg2.connect(
-                dbname=self.dbname,
-                user=self.user,
-                password=self.password,
-                host=self.host,
-                port=self.port
-            )
-            if not self.check_table_exists(DB_CONFIG['table_name']):
-                self.create_users_table()
+            if broken or conn.closed:
+                self._stats["discarded"] += 1
+                self._forget(conn)
+                self._pool.putconn(conn, close=True)
             else:
-                logging.info(f"Таблица {DB_CONFIG['table_name']} существует")
+                self._last_used[id(conn)] = time.monotonic()
+                self._pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Выдаёт соединение из пула на единицу работы и возвращает его обратно.
+        Вложенные вызовы в том же потоке переиспользуют уже выданное соединение,
+        фиксация транзакции выполняется внешним блоком. Блок не должен захватывать await.
+        :return: соединение psycopg2
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
 
-            if not self.check_table_exists('tracked_issues'):
-                self.create_tracked_issues_table()
+        conn = self._checkout()
+        self._local.conn = conn
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException as e:
+            broken = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            # После отката неизвестно, какие PREPARE успели выполниться: перечитаем при следующем запросе
+            self._prepared.pop(id(conn), None)
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            raise
+        finally:
+            self._local.conn = None
+            self._release(conn, broken)
 
-            if not self.check_table_exists('issue_subscriptions'):
-                self.create_issue_subscriptions_table()
+    def dedicated_connection(self):
+        """
+        Открывает отдельное соединение вне пула, например для LISTEN.
+        :return: соединение psycopg2 в режиме autocommit
+        """
+        conn = psycopg2.connect(
+            dbname=self.dbname,
+            user=self.user,
+            password=self.password,
+            host=self.host,
+            port=self.port
+        )
+        conn.autocommit = True
+        return conn
 
-            return self.conn
-        except psycopg2.Error as e:
-            logging.warning(f"Ошибка при выполнении запроса: {e}")
-        return None
+    @staticmethod
+    def _publish(cur, channel: str, event: str, project_id: int, issue_iid: int):
+        """Публикует событие NOTIFY, подписчики получат его после фиксации транзакции."""
+        payload = json.dumps({"event": event, "project_id": project_id, "issue_iid": issue_iid})
+        cur.execute("SELECT pg_notify(%s, %s)", (channel, payload))
 
-    def __exit__(self, type, value, traceback):
-        if self.conn:
-            if type:
-                self.conn.rollback()
-            else:
-                self.conn.commit()
-            self.conn.close()
+    def _execute_prepared(self, cur, name: str, params: tuple):
+        """
+        Выполняет запрос из PREPARED_STATEMENTS, при первом обращении на соединении готовит его на сервере
+        :param cur: курсор соединения, выданного connection()
+        """
+        conn = cur.connection
+        prepared = self._prepared.get(id(conn))
+        if prepared is None:
+            cur.execute("SELECT name FROM pg_prepared_statements")
+            prepared = self._prepared[id(conn)] = {row[0] for row in cur.fetchall()}
+        if name not in prepared:
+            cur.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+            prepared.add(name)
+        placeholders = ", ".join(["%s"] * len(params))
+        cur.execute(f"EXECUTE {name} ({placeholders})", params)
 
-    def get_user_by_telegram_id(self, telegram_id):
+    def pool_stats(self):
+        """
+        Статистика пула соединений
+        :return: словарь со счётчиками выдачи, ожиданий и отброшенных соединений
+        """
+        stats = dict(self._stats)
+        stats["user_cache"] = self.user_cache.stats()
+        stats["minconn"] = self.minconn
+        stats["maxconn"] = self.maxconn
+        if self._pool is not None:
+            stats["idle"] = len(self._pool._pool)
+            stats["in_use"] = len(self._pool._used)
+        else:
+            stats["idle"] = stats["in_use"] = 0
+        return stats
+
+    def close(self):
+        """Закрывает все соединения пула."""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+                self._last_used.clear()
+                self._prepared.clear()
+
+    def migrate(self):
+        """
+        Применяет недостающие миграции из migrations.MIGRATIONS.
+        Вызывается один раз при старте, параллельные экземпляры сериализуются advisory-блокировкой.
+        :return: список применённых версий
+        """
+        applied_now = []
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_ID,))
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version     INTEGER   PRIMARY KEY,
+                        description TEXT      NOT NULL,
+                        applied_at  TIMESTAMP NOT NULL DEFAULT NOW()
+                    )
+                """)
+                cur.execute("SELECT version FROM schema_migrations")
+                applied = {row[0] for row in cur.fetchall()}
+
+                for version, description, query in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    cur.execute(query)
+                    cur.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                        (version, description)
+                    )
+                    applied_now.append(version)
+                    logging.info(f"Миграция {version} применена: {description}")
+        if not applied_now:
+            logging.info("Схема БД актуальна, миграции не требуются")
+        return applied_now
+
+    def _get_user(self, field: str, value):
+        found, user = self.user_cache.get((field, value))
+        if found:
+            return user
         try:
-            with self as conn:
+            with self.connection() as conn:
                 with conn.cursor() as cur:
-                    cur.execute(f"SELECT *  FROM users where telegram_id={telegram_id}")
+                    self._execute_prepared(cur, f"user_by_{field}", (value,))
                     row = cur.fetchone()
+                    result = None
                     if row:
                         colnames = [desc[0] for desc in cur.description]
                         result = dict(zip(colnames, row))
                         logging.info(f"Пользователь найден {result}")
-                        return result
-                    else:
-                        return None
         except psycopg2.Error as e:
             logging.warning(f"Ошибка при выполнении запроса: {e}")
             return None
+        self.user_cache.put((field, value), result)
+        return dict(result) if result else None
+
+    def get_user_by_telegram_id(self, telegram_id):
+        return self._get_user('telegram_id', telegram_id)
 
     def get_user_by_gitlab_id(self, gitlab_id):
+        return self._get_user('gitlab_id', gitlab_id)
+
+    def try_advisory_lock(self, lock_id: int):
+        """
+        Берёт сессионную advisory-блокировку на отдельном соединении, чтобы долгую работу
+        (с запросами к GitLab между обращениями к БД) выполнял только один экземпляр бота
+        :return: соединение, держащее блокировку, или None, если её держит другой экземпляр
+        """
+        conn = self.dedicated_connection()
         try:
-            with self as conn:
-                with conn.cursor() as cur:
-                    cur.execute(f"SELECT *  FROM users where gitlab_id={gitlab_id}")
-                    row = cur.fetchone()
-                    if row:
-                        colnames = [desc[0] for desc in cur.description]
-                        result = dict(zip(colnames, row))
-                        logging.info(f"Пользователь найден {result}")
-                        return result
-                    else:
-                        return None
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (lock_id,))
+                if cur.fetchone()[0]:
+                    return conn
+        except psycopg2.Error:
+            conn.close()
+            raise
+        conn.close()
+        return None
+
+    @staticmethod
+    def release_advisory_lock(conn, lock_id: int):
+        """Снимает блокировку, взятую try_advisory_lock, и закрывает её соединение."""
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (lock_id,))
         except psycopg2.Error as e:
-            logging.warning(f"Ошибка при выполнении запроса: {e}")
-            return None
+            logging.warning(f"Не удалось снять advisory-блокировку {lock_id}: {e}")
+        finally:
+            conn.close()
+
+    def get_known_telegram_ids(self):
+        """
+        :return: множество telegram_id пользователей, уже заведённых в БД
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT telegram_id FROM users")
+                return {row[0] for row in cur.fetchall()}
 
     def create_user(self, telegram_id, gitlab_id='', gitlab_login='', gitlab_token='', telegram_chat_id=None):
         try:
-            with self as conn:
+            with self.connection() as conn:
                 with conn.cursor() as cur:
                     query = f"""
                                 INSERT INTO users (telegram_id, gitlab_id, gitlab_login, gitlab_token, telegram_chat_id)
@@ -140,30 +416,20 @@ class Database:
                         'telegram_chat_id': telegram_chat_id
                     }
                     logging.info(f"Пользователь создан {user_id}")
+            # Сбрасываем кэш после фиксации, иначе параллельный запрос мог бы снова закэшировать отсутствие
+            self.user_cache.invalidate(telegram_id=telegram_id, gitlab_id=gitlab_id)
             return user_id
+        except psycopg2.IntegrityError as e:
+            # Пользователя уже завёл другой экземпляр: закэшированное отсутствие больше неверно
+            self.user_cache.invalidate(telegram_id=telegram_id, gitlab_id=gitlab_id)
+            logging.warning(f"Пользователь {telegram_id} уже есть в БД: {e}")
+            return None
         except psycopg2.Error as e:
             logging.warning(f"Ошибка при выполнении запроса: {e}")
             return None
 
-    def create_tracked_issues_table(self):
-        """Создает таблицу для отслеживания созданных задач и последних комментариев."""
-        query = sql.SQL("""
-            CREATE TABLE IF NOT EXISTS tracked_issues (
-                project_id    INTEGER    NOT NULL,
-                issue_iid     INTEGER    NOT NULL,
-                telegram_chat_id BIGINT  NOT NULL,
-                notified      BOOLEAN    NOT NULL DEFAULT FALSE,
-                last_note_id  INTEGER    NOT NULL DEFAULT 0,
-                last_assignee_id INTEGER,
-                PRIMARY KEY   (project_id, issue_iid)
-            );
-        """)
-        with self.conn.cursor() as cur:
-            cur.execute(query)
-        self.conn.commit()
-
     def create_tracked_issue(self, project_id: int, issue_iid: int, telegram_chat_id: int):
-        with self as conn:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     "INSERT INTO tracked_issues (project_id, issue_iid, telegram_chat_id, last_note_id) "
@@ -171,13 +437,15 @@ class Database:
                     "ON CONFLICT DO NOTHING",
                     (project_id, issue_iid, telegram_chat_id, 0)
                 )
+                if cur.rowcount:
+                    self._publish(cur, TRACKED_ISSUES_CHANNEL, 'created', project_id, issue_iid)
 
     def get_all_tracked_issues(self):
         """
         Возвращает все отслеживаемые задачи с последним комментарием.
         :return: List of tuples (project_id, issue_iid, telegram_chat_id, last_note_id)
         """
-        with self as conn:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     SELECT project_id, issue_iid, telegram_chat_id, last_note_id, last_assignee_id
@@ -185,11 +453,189 @@ class Database:
                 """)
                 return cur.fetchall()
 
+    def claim_tracked_issues(self, owner: str, lease_ttl: float, retention: float | None = None):
+        """
+        Арендует долю отслеживаемых задач для экземпляра owner на lease_ttl секунд.
+        Доля - поровну между живыми экземплярами (отметившимися в sweep_instances за lease_ttl).
+        Свои задачи продлеваются в первую очередь, излишек сверх доли отпускается,
+        остальное добирается из свободных и просроченных задач, в том числе упавших экземпляров.
+        :param retention: экземпляры, не появлявшиеся дольше retention секунд, удаляются вместе с их отметками
+        :return: список словарей со столбцами tracked_issues; acquired=True у задач, полученных от другого владельца
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO sweep_instances (instance_id) VALUES (%s)
+                    ON CONFLICT (instance_id) DO UPDATE SET heartbeat_at = NOW()
+                """, (owner,))
+                if retention:
+                    cur.execute("""
+                        DELETE FROM sweep_instances
+                         WHERE heartbeat_at < NOW() - %s * INTERVAL '1 second'
+                    """, (retention,))
+                    cur.execute("""
+                        DELETE FROM project_watermarks w
+                         WHERE NOT EXISTS (SELECT 1 FROM sweep_instances i WHERE i.instance_id = w.owner)
+                    """)
+                    if cur.rowcount:
+                        logging.info(f"Удалено {cur.rowcount} отметок опроса давно остановленных экземпляров")
+                cur.execute("""
+                    SELECT (SELECT COUNT(*) FROM tracked_issues),
+                           (SELECT COUNT(*) FROM sweep_instances
+                             WHERE heartbeat_at > NOW() - %s * INTERVAL '1 second')
+                """, (lease_ttl,))
+                total, instances = cur.fetchone()
+                share = -(-total // max(instances, 1))
+
+                cur.execute("""
+                    UPDATE tracked_issues
+                       SET lease_owner = NULL,
+                           lease_expires_at = NULL
+                     WHERE (project_id, issue_iid) IN (
+                           SELECT project_id, issue_iid FROM tracked_issues
+                            WHERE lease_owner = %s
+                            ORDER BY project_id, issue_iid
+                           OFFSET %s
+                    )
+                """, (owner, share))
+                if cur.rowcount:
+                    logging.info(f"Экземпляр {owner} отпустил {cur.rowcount} задач для других экземпляров")
+
+                cur.execute("""
+                    WITH candidates AS (
+                        SELECT project_id, issue_iid, lease_owner AS previous_owner
+                          FROM tracked_issues
+                         WHERE lease_owner = %(owner)s
+                            OR lease_expires_at IS NULL
+                            OR lease_expires_at < NOW()
+                         ORDER BY lease_owner = %(owner)s DESC NULLS LAST, project_id, issue_iid
+                         LIMIT %(share)s
+                           FOR UPDATE SKIP LOCKED
+                    )
+                    UPDATE tracked_issues t
+                       SET lease_owner = %(owner)s,
+                           lease_expires_at = NOW() + %(ttl)s * INTERVAL '1 second'
+                      FROM candidates c
+                     WHERE t.project_id = c.project_id
+                       AND t.issue_iid = c.issue_iid
+                    RETURNING t.project_id, t.issue_iid, t.telegram_chat_id, t.last_note_id,
+                              t.last_assignee_id, t.notified, t.last_labels,
+                              c.previous_owner IS DISTINCT FROM %(owner)s AS acquired
+                """, {"owner": owner, "share": share, "ttl": lease_ttl})
+                colnames = [desc[0] for desc in cur.description]
+                return [dict(zip(colnames, row)) for row in cur.fetchall()]
+
+    def claim_tracked_issue(self, project_id: int, issue_iid: int, owner: str, lease_ttl: float):
+        """
+        Арендует одну задачу, если она свободна, просрочена или уже принадлежит owner
+        :return: словарь со столбцами tracked_issues или None, если задача не отслеживается или занята
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    WITH candidate AS (
+                        SELECT project_id, issue_iid, lease_owner AS previous_owner
+                          FROM tracked_issues
+                         WHERE project_id = %(project_id)s
+                           AND issue_iid = %(issue_iid)s
+                           AND (lease_owner = %(owner)s
+                                OR lease_expires_at IS NULL
+                                OR lease_expires_at < NOW())
+                           FOR UPDATE SKIP LOCKED
+                    )
+                    UPDATE tracked_issues t
+                       SET lease_owner = %(owner)s,
+                           lease_expires_at = GREATEST(t.lease_expires_at, NOW() + %(ttl)s * INTERVAL '1 second')
+                      FROM candidate c
+                     WHERE t.project_id = c.project_id
+                       AND t.issue_iid = c.issue_iid
+                    RETURNING t.project_id, t.issue_iid, t.telegram_chat_id, t.last_note_id,
+                              t.last_assignee_id, t.notified, t.last_labels,
+                              c.previous_owner IS DISTINCT FROM %(owner)s AS acquired
+                """, {"project_id": project_id, "issue_iid": issue_iid, "owner": owner, "ttl": lease_ttl})
+                row = cur.fetchone()
+                if row is None:
+                    return None
+                colnames = [desc[0] for desc in cur.description]
+                return dict(zip(colnames, row))
+
+    def release_tracked_issues(self, owner: str, lease_ttl: float):
+        """
+        Отпускает все задачи экземпляра, например при остановке, чтобы их сразу забрали другие.
+        Запись экземпляра остаётся, но перестаёт считаться живой: после перезапуска с тем же именем
+        он продолжит со своих отметок опроса
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE tracked_issues
+                       SET lease_owner = NULL,
+                           lease_expires_at = NULL
+                     WHERE lease_owner = %s
+                """, (owner,))
+                released = cur.rowcount
+                cur.execute("""
+                    UPDATE sweep_instances
+                       SET heartbeat_at = NOW() - %s * INTERVAL '1 second'
+                     WHERE instance_id = %s
+                """, (lease_ttl, owner))
+                return released
+
+    def release_tracked_issue(self, project_id: int, issue_iid: int, owner: str):
+        """Отпускает одну задачу, арендованную owner только на время обработки."""
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE tracked_issues
+                       SET lease_owner = NULL,
+                           lease_expires_at = NULL
+                     WHERE project_id = %s
+                       AND issue_iid = %s
+                       AND lease_owner = %s
+                """, (project_id, issue_iid, owner))
+
+    def request_issue_processing(self, project_id: int, issue_iid: int):
+        """Просит экземпляр, арендовавший задачу, обработать её вне очереди."""
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                self._publish(cur, TRACKED_ISSUES_CHANNEL, 'changed', project_id, issue_iid)
+
+    def update_last_labels(self, project_id: int, issue_iid: int, labels: list[str]):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE tracked_issues
+                       SET last_labels = %s
+                     WHERE project_id = %s
+                       AND issue_iid = %s
+                """, (labels, project_id, issue_iid))
+
+    def get_project_watermarks(self, owner: str):
+        """
+        :return: словарь project_id -> updated_at последней задачи проекта, обработанной экземпляром owner
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT project_id, updated_after FROM project_watermarks WHERE owner = %s", (owner,))
+                return dict(cur.fetchall())
+
+    def set_project_watermark(self, project_id: int, owner: str, updated_after: datetime.datetime):
+        """Сдвигает отметку проекта вперёд, назад отметка не откатывается."""
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO project_watermarks (project_id, owner, updated_after)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (project_id, owner) DO UPDATE
+                       SET updated_after = GREATEST(project_watermarks.updated_after, EXCLUDED.updated_after),
+                           stored_at = NOW()
+                """, (project_id, owner, updated_after))
+
     def update_last_note_id(self, project_id: int, issue_iid: int, new_last_id: int):
         """
         Обновляет last_note_id для указанной задачи.
         """
-        with self as conn:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     UPDATE tracked_issues
@@ -197,43 +643,70 @@ class Database:
                     WHERE project_id = %s AND issue_iid = %s
                 """, (new_last_id, project_id, issue_iid))
 
+    def _bulk_update_tracked_issues(self, column: str, cast: str, rows: list[tuple]):
+        """
+        Обновляет один столбец tracked_issues у многих задач одним запросом
+        :param rows: список кортежей (project_id, issue_iid, значение)
+        """
+        if not rows:
+            return 0
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                execute_values(cur, f"""
+                    UPDATE tracked_issues AS t
+                       SET {column} = v.value
+                      FROM (VALUES %s) AS v (project_id, issue_iid, value)
+                     WHERE t.project_id = v.project_id
+                       AND t.issue_iid = v.issue_iid
+                """, rows, template=f"(%s, %s, %s::{cast})", page_size=len(rows))
+                return cur.rowcount
+
+    def bulk_update_last_note_id(self, rows: list[tuple[int, int, int]]):
+        return self._bulk_update_tracked_issues("last_note_id", "integer", rows)
+
+    def bulk_update_last_assignee_id(self, rows: list[tuple[int, int, int | None]]):
+        return self._bulk_update_tracked_issues("last_assignee_id", "integer", rows)
+
+    def bulk_update_last_labels(self, rows: list[tuple[int, int, list[str]]]):
+        return self._bulk_update_tracked_issues("last_labels", "text[]", rows)
+
+    def bulk_mark_issues_notified(self, keys: list[tuple[int, int]]):
+        """
+        :param keys: список кортежей (project_id, issue_iid)
+        """
+        if not keys:
+            return 0
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                execute_values(cur, """
+                    UPDATE tracked_issues AS t
+                       SET notified = TRUE,
+                           notified_at = NOW()
+                      FROM (VALUES %s) AS v (project_id, issue_iid)
+                     WHERE t.project_id = v.project_id
+                       AND t.issue_iid = v.issue_iid
+                """, keys, page_size=len(keys))
+                return cur.rowcount
+
     def add_subscription(self, telegram_id: int, project_id: int, issue_iid: int):
-        with self as conn:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     INSERT INTO issue_subscriptions (user_telegram_id, project_id, issue_iid)
                     VALUES (%s, %s, %s)
                     ON CONFLICT DO NOTHING;
                 """, (telegram_id, project_id, issue_iid))
+                if cur.rowcount:
+                    self._publish(cur, ISSUE_SUBSCRIPTIONS_CHANNEL, 'subscribed', project_id, issue_iid)
 
     def get_subscribers(self, project_id: int, issue_iid: int):
-        with self as conn:
+        with self.connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("""
-                    SELECT user_telegram_id FROM issue_subscriptions
-                    WHERE project_id = %s AND issue_iid = %s;
-                """, (project_id, issue_iid))
+                self._execute_prepared(cur, "issue_subscribers", (project_id, issue_iid))
                 return [row[0] for row in cur.fetchall()]
 
-    def create_issue_subscriptions_table(self):
-        """Создаёт таблицу для подписок на обновления по задачам."""
-        query = sql.SQL("""
-            CREATE TABLE IF NOT EXISTS issue_subscriptions (
-                id SERIAL PRIMARY KEY,
-                user_telegram_id BIGINT NOT NULL,
-                project_id INTEGER NOT NULL,
-                issue_iid INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user_telegram_id, project_id, issue_iid)
-            );
-        """)
-        with self.conn.cursor() as cur:
-            cur.execute(query)
-        self.conn.commit()
-        logging.info("Таблица issue_subscriptions создана")
-
     def get_unnotified_issues(self):
-        with self as conn:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     SELECT project_id, issue_iid, telegram_chat_id
@@ -243,7 +716,7 @@ class Database:
                 return cur.fetchall()
 
     def mark_issue_notified(self, project_id: int, issue_iid: int):
-        with self as conn:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     UPDATE tracked_issues
@@ -253,7 +726,7 @@ class Database:
                 """, (project_id, issue_iid))
 
     def get_notified_unacked_older_than(self, cutoff: datetime.datetime):
-        with self as conn:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     SELECT project_id, issue_iid, telegram_chat_id
@@ -264,7 +737,7 @@ class Database:
                 return cur.fetchall()
 
     def mark_issue_unnotified(self, project_id: int, issue_iid: int):
-        with self as conn:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     UPDATE tracked_issues
@@ -272,9 +745,11 @@ class Database:
                      WHERE project_id = %s
                        AND issue_iid = %s;
                 """, (project_id, issue_iid))
+                if cur.rowcount:
+                    self._publish(cur, TRACKED_ISSUES_CHANNEL, 'unnotified', project_id, issue_iid)
 
     def delete_tracked_issue(self, project_id: int, issue_iid: int):
-        with self as conn:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     """
@@ -283,9 +758,42 @@ class Database:
                     """,
                     (project_id, issue_iid)
                 )
+                if cur.rowcount:
+                    self._publish(cur, TRACKED_ISSUES_CHANNEL, 'deleted', project_id, issue_iid)
+                cur.execute(
+                    "DELETE FROM issue_snapshots WHERE project_id = %s AND issue_iid = %s",
+                    (project_id, issue_iid)
+                )
+
+    def bulk_delete_tracked_issues(self, keys: list[tuple[int, int]]):
+        """
+        Удаляет задачи и их снимки одной транзакцией
+        :param keys: список кортежей (project_id, issue_iid)
+        :return: список удалённых (project_id, issue_iid)
+        """
+        if not keys:
+            return []
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                deleted = execute_values(cur, """
+                    DELETE FROM tracked_issues AS t
+                     USING (VALUES %s) AS v (project_id, issue_iid)
+                     WHERE t.project_id = v.project_id
+                       AND t.issue_iid = v.issue_iid
+                 RETURNING t.project_id, t.issue_iid
+                """, keys, page_size=len(keys), fetch=True)
+                for project_id, issue_iid in deleted:
+                    self._publish(cur, TRACKED_ISSUES_CHANNEL, 'deleted', project_id, issue_iid)
+                execute_values(cur, """
+                    DELETE FROM issue_snapshots AS s
+                     USING (VALUES %s) AS v (project_id, issue_iid)
+                     WHERE s.project_id = v.project_id
+                       AND s.issue_iid = v.issue_iid
+                """, keys, page_size=len(keys))
+                return [tuple(row) for row in deleted]
 
     def update_last_assignee_id(self, project_id: int, issue_iid: int, assignee_id: int | None):
-        with self as conn:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     UPDATE tracked_issues
@@ -294,6 +802,190 @@ class Database:
                        AND issue_iid = %s
                 """, (assignee_id, project_id, issue_iid))
 
+    def get_telegram_file_id(self, project_id: int, upload_path: str, media_type: str):
+        """
+        :return: file_id Telegram для вложения GitLab или None, если файл ещё не отправлялся
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT file_id FROM telegram_file_cache
+                     WHERE project_id = %s AND upload_path = %s AND media_type = %s
+                """, (project_id, upload_path, media_type))
+                row = cur.fetchone()
+                return row[0] if row else None
+
+    def get_telegram_file_id_by_hash(self, content_hash: str, media_type: str):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT file_id FROM telegram_file_cache
+                     WHERE content_hash = %s AND media_type = %s
+                     LIMIT 1
+                """, (content_hash, media_type))
+                row = cur.fetchone()
+                return row[0] if row else None
+
+    def save_telegram_file_id(self, project_id: int, upload_path: str, media_type: str,
+                              content_hash: str, file_id: str):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO telegram_file_cache (project_id, upload_path, media_type, content_hash, file_id)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (project_id, upload_path, media_type) DO UPDATE
+                       SET content_hash = EXCLUDED.content_hash,
+                           file_id = EXCLUDED.file_id,
+                           created_at = NOW()
+                """, (project_id, upload_path, media_type, content_hash, file_id))
+
+    def save_issue_snapshot(self, snapshot: dict):
+        """
+        Сохраняет снимок задачи GitLab, если задача ещё отслеживается:
+        снимок задачи, удалённой во время обхода, не создаётся заново
+        :param snapshot: словарь со столбцами issue_snapshots, см. sweep.build_issue_snapshot
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO issue_snapshots (project_id, issue_iid, title, state, description, author_name,
+                                                 assignee_id, assignee_name, closed_at, closing_comment,
+                                                 recent_notes)
+                    SELECT %(project_id)s, %(issue_iid)s, %(title)s, %(state)s, %(description)s, %(author_name)s,
+                           %(assignee_id)s, %(assignee_name)s, %(closed_at)s, %(closing_comment)s,
+                           %(recent_notes)s
+                     WHERE EXISTS (SELECT 1 FROM tracked_issues
+                                    WHERE project_id = %(project_id)s AND issue_iid = %(issue_iid)s)
+                    ON CONFLICT (project_id, issue_iid) DO UPDATE
+                       SET title = EXCLUDED.title,
+                           state = EXCLUDED.state,
+                           description = EXCLUDED.description,
+                           author_name = EXCLUDED.author_name,
+                           assignee_id = EXCLUDED.assignee_id,
+                           assignee_name = EXCLUDED.assignee_name,
+                           closed_at = EXCLUDED.closed_at,
+                           closing_comment = EXCLUDED.closing_comment,
+                           recent_notes = EXCLUDED.recent_notes,
+                           refreshed_at = NOW(),
+                           checked_at = NOW()
+                """, {**snapshot, "recent_notes": Json(snapshot["recent_notes"])})
+
+    def delete_orphan_issue_snapshots(self) -> int:
+        """
+        Удаляет снимки задач, которые больше не отслеживаются
+        :return: число удалённых снимков
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM issue_snapshots AS s
+                     WHERE NOT EXISTS (SELECT 1 FROM tracked_issues AS t
+                                        WHERE t.project_id = s.project_id
+                                          AND t.issue_iid = s.issue_iid)
+                """)
+                return cur.rowcount
+
+    def touch_issue_snapshots(self, project_id: int, issue_iids: list[int]):
+        """Отмечает снимки задач проекта актуальными: обход убедился, что задачи не менялись."""
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE issue_snapshots
+                       SET checked_at = NOW()
+                     WHERE project_id = %s
+                       AND issue_iid = ANY(%s)
+                """, (project_id, issue_iids))
+
+    def get_chat_issue_snapshots(self, telegram_chat_id: int):
+        """
+        Отслеживаемые задачи чата вместе со снимками одним запросом
+        :return: список словарей; у задач без снимка столбцы снимка равны None
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT t.project_id, t.issue_iid, s.title, s.state, s.description, s.author_name,
+                           s.assignee_id, s.assignee_name, s.closed_at, s.closing_comment, s.recent_notes,
+                           s.refreshed_at, s.checked_at
+                      FROM tracked_issues t
+                      LEFT JOIN issue_snapshots s
+                        ON s.project_id = t.project_id AND s.issue_iid = t.issue_iid
+                     WHERE t.telegram_chat_id = %s
+                """, (telegram_chat_id,))
+                colnames = [desc[0] for desc in cur.description]
+                return [dict(zip(colnames, row)) for row in cur.fetchall()]
+
+    def get_issue_snapshot(self, project_id: int, issue_iid: int):
+        """
+        :return: словарь со столбцами issue_snapshots или None
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT project_id, issue_iid, title, state, description, author_name,
+                           assignee_id, assignee_name, closed_at, closing_comment, recent_notes,
+                           refreshed_at, checked_at
+                      FROM issue_snapshots
+                     WHERE project_id = %s AND issue_iid = %s
+                """, (project_id, issue_iid))
+                row = cur.fetchone()
+                if row is None:
+                    return None
+                colnames = [desc[0] for desc in cur.description]
+                return dict(zip(colnames, row))
+
+    def get_fsm_state(self, storage_key: str):
+        """
+        :return: кортеж (state, data, version) или None, если для ключа ничего не сохранено
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT state, data, version FROM fsm_states WHERE storage_key = %s
+                """, (storage_key,))
+                return cur.fetchone()
+
+    def save_fsm_state(self, storage_key: str, state: str | None, data: dict, version: int):
+        """
+        Сохраняет состояние FSM, только если в БД всё ещё версия version (0 - записи ещё нет)
+        :return: новая версия или None, если запись уже изменил другой экземпляр бота
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                if version == 0:
+                    cur.execute("""
+                        INSERT INTO fsm_states (storage_key, state, data)
+                        VALUES (%s, %s, %s)
+                        ON CONFLICT (storage_key) DO NOTHING
+                        RETURNING version
+                    """, (storage_key, state, Json(data)))
+                else:
+                    cur.execute("""
+                        UPDATE fsm_states
+                           SET state = %s,
+                               data = %s,
+                               version = version + 1,
+                               updated_at = NOW()
+                         WHERE storage_key = %s
+                           AND version = %s
+                        RETURNING version
+                    """, (state, Json(data), storage_key, version))
+                row = cur.fetchone()
+                return row[0] if row else None
+
+    def delete_idle_fsm_states(self, ttl_seconds: float):
+        """
+        Удаляет брошенные сессии FSM, не менявшиеся дольше ttl_seconds
+        :return: число удалённых записей
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM fsm_states
+                     WHERE updated_at < NOW() - %s * INTERVAL '1 second'
+                """, (ttl_seconds,))
+                return cur.rowcount
+
 db = Database(
     dbname=DB_CONFIG['dbname'],
     user=DB_CONFIG['user'],
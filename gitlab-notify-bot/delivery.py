@@ -0,0 +1,249 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Awaitable, Callable
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod, SendMediaGroup
+from dotenv import load_dotenv
+
+load_dotenv()
+DELIVERY_CONFIG = {
+    "global_rate": float(os.getenv("TELEGRAM_GLOBAL_RATE", "30")),
+    "chat_rate": float(os.getenv("TELEGRAM_CHAT_RATE", "1")),
+    "chat_burst": float(os.getenv("TELEGRAM_CHAT_BURST", "3")),
+    "group_rate": float(os.getenv("TELEGRAM_GROUP_RATE_PER_MINUTE", "20")) / 60,
+    "max_retries": int(os.getenv("TELEGRAM_MAX_RETRIES", "3")),
+    # Как часто метрики очереди пишутся в лог, 0 - только при остановке
+    "metrics_interval": float(os.getenv("TELEGRAM_OUTBOX_METRICS_INTERVAL", "300")),
+}
+# Методы Bot API, которые отправляют сообщения в чат и подпадают под лимиты Telegram
+THROTTLED_METHOD_PREFIXES = ("Send", "Copy", "Forward")
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BULK = 1
+
+
+delivery_priority: ContextVar[Priority] = ContextVar("delivery_priority", default=Priority.INTERACTIVE)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, cost: float = 1, now: float | None = None) -> float:
+        """
+        :return: сколько секунд ждать, пока в ведре хватит токенов (0 - можно отправлять)
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        needed = min(cost, self.capacity)
+        wait = max(self.blocked_until - now, 0)
+        if self.tokens < needed:
+            wait = max(wait, (needed - self.tokens) / self.rate)
+        return wait
+
+    def consume(self, cost: float = 1):
+        # Стоимость больше ёмкости (альбом) уводит ведро в минус, следующие отправки подождут
+        self.tokens -= cost
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+@dataclass(order=True)
+class _Job:
+    priority: int
+    seq: int
+    chat_id: int | str = field(compare=False)
+    send: Callable[[], Awaitable[Any]] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    cost: float = field(default=1, compare=False)
+    enqueued_at: float = field(default_factory=time.monotonic, compare=False)
+    attempts: int = field(default=0, compare=False)
+
+
+class TelegramOutbox:
+    """
+    Единая очередь исходящих сообщений Telegram.
+    Соблюдает общий лимит бота и лимиты отдельных чатов (ведра токенов), учитывает
+    retry_after из ответа 429 и пропускает интерактивные ответы раньше массовых уведомлений.
+    """
+
+    def __init__(self, global_rate: float = DELIVERY_CONFIG['global_rate'],
+                 chat_rate: float = DELIVERY_CONFIG['chat_rate'],
+                 chat_burst: float = DELIVERY_CONFIG['chat_burst'],
+                 group_rate: float = DELIVERY_CONFIG['group_rate'],
+                 max_retries: int = DELIVERY_CONFIG['max_retries'],
+                 metrics_interval: float = DELIVERY_CONFIG['metrics_interval']):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.metrics_interval = metrics_interval
+        self._chat_buckets: dict[int | str, TokenBucket] = {}
+        self._queue: asyncio.PriorityQueue | None = None
+        self._worker: asyncio.Task | None = None
+        self._reporter: asyncio.Task | None = None
+        self._sending: set[asyncio.Task] = set()
+        self._seq = itertools.count()
+        self._depth = {priority: 0 for priority in Priority}
+        self._stats = {"sent": 0, "failed": 0, "retries": 0, "cancelled": 0,
+                       "latency_total": 0.0, "latency_max": 0.0}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные id - группы и каналы, у них лимит 20 сообщений в минуту
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._queue = self._queue or asyncio.PriorityQueue()
+            self._worker = asyncio.create_task(self._run())
+        if self.metrics_interval > 0 and (self._reporter is None or self._reporter.done()):
+            self._reporter = asyncio.create_task(self._report())
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            logging.info(f"Очередь отправки Telegram: {self.metrics()}")
+
+    async def submit(self, chat_id, send: Callable[[], Awaitable[Any]], priority: Priority | None = None,
+                     cost: float = 1):
+        """
+        Ставит отправку в очередь и ждёт её результата
+        :param chat_id: чат получателя
+        :param send: функция без аргументов, возвращающая корутину отправки
+        :param priority: полоса очереди, по умолчанию берётся из delivery_priority
+        :param cost: число сообщений, которое создаст отправка (для альбомов - число файлов)
+        :return: результат send
+        """
+        self._ensure_worker()
+        priority = delivery_priority.get() if priority is None else priority
+        job = _Job(priority=priority, seq=next(self._seq), chat_id=chat_id, send=send,
+                   future=asyncio.get_running_loop().create_future(), cost=cost)
+        self._depth[priority] += 1
+        self._queue.put_nowait(job)
+        return await job.future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            if job.future.done():
+                # Отправитель уже не ждёт результата (например, задачу обхода отменил дедлайн)
+                self._depth[job.priority] -= 1
+                self._stats["cancelled"] += 1
+                continue
+            chat_bucket = self._chat_bucket(job.chat_id)
+            chat_delay = chat_bucket.delay(job.cost)
+            if chat_delay > 0:
+                # Чат занят - откладываем только его сообщение, остальные чаты не ждут
+                loop.call_later(chat_delay, self._queue.put_nowait, job)
+                continue
+            global_delay = self.global_bucket.delay(job.cost)
+            if global_delay > 0:
+                # Возвращаем задание в очередь: за время ожидания может прийти более срочное
+                self._queue.put_nowait(job)
+                await asyncio.sleep(global_delay)
+                continue
+
+            chat_bucket.consume(job.cost)
+            self.global_bucket.consume(job.cost)
+            task = asyncio.create_task(self._send(job))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, job: _Job):
+        job.attempts += 1
+        try:
+            result = await job.send()
+        except TelegramRetryAfter as e:
+            self._chat_bucket(job.chat_id).block(e.retry_after)
+            if job.attempts <= self.max_retries:
+                self._stats["retries"] += 1
+                logging.warning(f"Telegram попросил подождать {e.retry_after} с для чата {job.chat_id}, повторим")
+                self._queue.put_nowait(job)
+                return
+            self._finish(job, exception=e)
+        except Exception as e:
+            self._finish(job, exception=e)
+        else:
+            self._finish(job, result=result)
+
+    def _finish(self, job: _Job, result=None, exception: BaseException | None = None):
+        self._depth[job.priority] -= 1
+        latency = time.monotonic() - job.enqueued_at
+        if exception is not None:
+            self._stats["failed"] += 1
+            if not job.future.done():
+                job.future.set_exception(exception)
+            return
+        self._stats["sent"] += 1
+        self._stats["latency_total"] += latency
+        self._stats["latency_max"] = max(self._stats["latency_max"], latency)
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def metrics(self) -> dict:
+        sent = self._stats["sent"]
+        return {
+            "queue_depth": {priority.name.lower(): depth for priority, depth in self._depth.items()},
+            "in_flight": len(self._sending),
+            "sent": sent,
+            "failed": self._stats["failed"],
+            "retries": self._stats["retries"],
+            "cancelled": self._stats["cancelled"],
+            "latency_avg": self._stats["latency_total"] / sent if sent else 0.0,
+            "latency_max": self._stats["latency_max"],
+        }
+
+    async def close(self):
+        for task in (self._worker, self._reporter):
+            if task is not None:
+                task.cancel()
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        logging.info(f"Очередь отправки Telegram остановлена: {self.metrics()}")
+
+
+class OutboxRequestMiddleware(BaseRequestMiddleware):
+    """Направляет все отправки сообщений бота через TelegramOutbox."""
+
+    def __init__(self, outbox: TelegramOutbox):
+        self.outbox = outbox
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(THROTTLED_METHOD_PREFIXES):
+            return await make_request(bot, method)
+        cost = len(method.media) if isinstance(method, SendMediaGroup) else 1
+        return await self.outbox.submit(chat_id, lambda: make_request(bot, method), cost=cost)
+
+
+def setup_outbox(bot: Bot, outbox: TelegramOutbox | None = None) -> TelegramOutbox:
+    outbox = outbox or TelegramOutbox()
+    bot.session.middleware(OutboxRequestMiddleware(outbox))
+    return outbox
@@ -1,15 +1,27 @@
+import hmac
 import logging
 import os
-import re
 
-import requests
-from fastapi import FastAPI, Body
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from dotenv import load_dotenv
+from fastapi import FastAPI, Body, BackgroundTasks, Header, HTTPException
 
 from db import Database
+from async_db import AsyncDatabase
+from gitlab_client import GitLabClient
+from sweep import INSTANCE_ID, IssueSweep, SweepContext
+from attachments import AttachmentRelay
+from delivery import Priority, delivery_priority, setup_outbox
+
+load_dotenv()
 
 app = FastAPI()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+GITLAB_HOST = os.getenv("GITLAB_HOST")
+GITLAB_TOKEN = os.getenv("GITLAB_TOKEN")
+GITLAB_WEBHOOK_SECRET = os.getenv("GITLAB_WEBHOOK_SECRET")
 DB_CONFIG = {
     "dbname": os.getenv("DB_NAME"),
     "user": os.getenv("DB_USER"),
@@ -19,10 +31,9 @@ DB_CONFIG = {
     "table_name": os.getenv("DB_TABLE_NAME")
 }
 
-ISSUE_ACTION_TRANSLATE = {
-    'close': 'закрыта',
-    'reopen': 'открыта'
-}
+# Изменения задачи, на которые реагируют детекторы обхода
+ISSUE_HOOK_ACTIONS = {'close', 'reopen', 'update'}
+ISSUE_HOOK_CHANGES = {'assignees', 'labels', 'state_id', 'closed_at'}
 
 db = Database(
     dbname=DB_CONFIG['dbname'],
@@ -30,30 +41,64 @@ db = Database(
     password=DB_CONFIG['password'],
     host=DB_CONFIG['host'],
     port=DB_CONFIG['port'])
+adb = AsyncDatabase(db)
+bot = Bot(token=TELEGRAM_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+outbox = setup_outbox(bot)
+gitlab = GitLabClient(GITLAB_HOST, GITLAB_TOKEN)
+# Вебхук не ведёт цикл опроса: задачи он арендует только на время обработки, под своим именем,
+# чтобы не пересекаться с ботом на том же хосте
+sweep = IssueSweep(SweepContext(bot=bot, db=adb, gitlab=gitlab, relay=AttachmentRelay(gitlab, adb)),
+                   instance_id=f"{INSTANCE_ID}:webhook")
 
-def send_telegram_message(chat_id: int, text: str):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": chat_id,
-        "text": text,
-        "parse_mode": "HTML"
-    }
-    requests.post(url, json=payload)
 
-
-def parse_comment(comment):
+def get_issue_key(data: dict):
     """
-    Разбирает строку и возвращает словарь с пользователями и сообщением
-
-    :param comment: Строка в формате "@user1, @user2 сообщение"
-    :return: Словарь с ключами "users" и "message"
+    Определяет задачу, к которой относится событие вебхука GitLab
+    :param data: тело Note Hook или Issue Hook
+    :return: кортеж (project_id, issue_iid) или None, если событие не влияет на уведомления
     """
-    pattern = r'@[\w\.]+'
-    users = re.findall(pattern, comment)
+    object_kind = data.get('object_kind')
+    attributes = data.get('object_attributes') or {}
+    project_id = (data.get('project') or {}).get('id') or data.get('project_id')
+
+    if object_kind == 'note':
+        if attributes.get('noteable_type') != 'Issue' or not data.get('issue'):
+            return None
+        return project_id, data['issue']['iid']
+
+    if object_kind == 'issue':
+        action = attributes.get('action')
+        if action not in ISSUE_HOOK_ACTIONS:
+            return None
+        if action == 'update' and not ISSUE_HOOK_CHANGES & set(data.get('changes') or {}):
+            return None
+        return project_id, attributes['iid']
+
+    return None
+
 
-    message = re.sub(pattern, '', comment).strip()
+async def process_issue_event(project_id: int, issue_iid: int):
+    delivery_priority.set(Priority.BULK)
+    try:
+        processed = await sweep.process_issue(project_id, issue_iid, handoff=True)
+        logging.info(f"Вебхук по задаче {project_id}#{issue_iid} обработан: {processed}")
+    except Exception as e:
+        logging.exception(f"Ошибка обработки вебхука по задаче {project_id}#{issue_iid}: {e}")
+
+
+@app.on_event("startup")
+async def on_startup():
+    await adb.migrate()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await sweep.release()
+    await gitlab.close()
+    await outbox.close()
+    await bot.session.close()
+    adb.close()
 
-    return {"users": users, "message": message}
 
 @app.get("/")
 async def root():
@@ -61,40 +106,19 @@ async def root():
 
 
 @app.post("/webhook")
-async def say_hello(data = Body()):
-    logging.info(data)
-    print(data)
-    event_type = data.get('event_type')
-
-    if event_type == 'note':
-        data = parse_comment(data)
-    elif event_type == 'issue':
-        if data['object_attributes']['action'] in ['close', 'reopen']:
-            comment = data['object_attributes']['note']
-            comment_data = was_changed_issue_state(comment)
-
-    return {"message": data}
-
-def was_changed_issue_state(data):
-    issue_type = ''
-    if data['object_attributes']['type'] == 'Incident':
-        issue_type = 'Проблема'
-    elif data['object_attributes']['type'] == 'Issue':
-        issue_type = 'Задача'
-
-    issue_action = ''
-    if data['object_attributes']['action'] == 'close':
-        issue_action = 'закрыта'
-    elif data['object_attributes']['action'] == 'reopen':
-        issue_action = 'открыта'
-
-    issue_title = data['object_attributes']['title']
-
-    if issue_type and issue_action:
-        message = f"<b>{issue_type}</b>#{data['object_attributes']['iid']} {issue_title} <b>{issue_action}</b>"
-        gitlab_user_id = data['user']['id']
-        user_db = db.get_user_by_gitlab_id(gitlab_user_id)
-        send_telegram_message(user_db['telegram_chat_id'], message)
+async def webhook(background_tasks: BackgroundTasks, data=Body(),
+                  x_gitlab_token: str | None = Header(default=None)):
+    if GITLAB_WEBHOOK_SECRET and not hmac.compare_digest(x_gitlab_token or '', GITLAB_WEBHOOK_SECRET):
+        raise HTTPException(status_code=401, detail="invalid token")
+
+    key = get_issue_key(data)
+    if key is None or key[0] is None:
+        return {"status": "ignored"}
+
+    # Отвечаем GitLab сразу, уведомления отправляются в фоне теми же детекторами, что и при опросе
+    background_tasks.add_task(process_issue_event, *key)
+    return {"status": "accepted"}
+
 
 @app.get("/ping")
 async def ping():
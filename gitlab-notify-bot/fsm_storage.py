@@ -0,0 +1,208 @@
+import asyncio
+import copy
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StorageKey, StateType
+from dotenv import load_dotenv
+
+from async_db import AsyncDatabase
+
+load_dotenv()
+FSM_STORAGE_CONFIG = {
+    # Через сколько секунд изменения сессии записываются в БД
+    "flush_delay": float(os.getenv("FSM_FLUSH_DELAY", "0.2")),
+    # Сколько секунд прочитанная из БД сессия считается свежей
+    "cache_ttl": float(os.getenv("FSM_CACHE_TTL", "2")),
+    "max_entries": int(os.getenv("FSM_CACHE_MAX_ENTRIES", "10000")),
+    # Сессии, не менявшиеся дольше этого срока, удаляются
+    "state_ttl": float(os.getenv("FSM_STATE_TTL", str(7 * 24 * 3600))),
+    "max_conflict_retries": int(os.getenv("FSM_MAX_CONFLICT_RETRIES", "3")),
+    # Наибольшая пауза между повторами записи, если БД недоступна
+    "max_retry_delay": float(os.getenv("FSM_MAX_RETRY_DELAY", "30")),
+}
+
+_MISSING = object()
+
+
+@dataclass
+class _Entry:
+    state: str | None
+    data: dict
+    version: int
+    # Состояние, на котором основаны локальные изменения, нужно для слияния при конфликте
+    base_state: str | None = None
+    base_data: dict = field(default_factory=dict)
+    loaded_at: float = field(default_factory=time.monotonic)
+    dirty: bool = False
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_states, общее для всех экземпляров бота.
+    Сессии кэшируются в процессе, изменения записываются в БД с задержкой flush_delay одной записью.
+    Каждая запись сравнивает версию строки: если сессию успел изменить другой экземпляр,
+    локально изменённые поля накладываются поверх его версии и запись повторяется.
+    """
+
+    def __init__(self, db: AsyncDatabase, key_builder: KeyBuilder | None = None,
+                 flush_delay: float = FSM_STORAGE_CONFIG['flush_delay'],
+                 cache_ttl: float = FSM_STORAGE_CONFIG['cache_ttl'],
+                 max_entries: int = FSM_STORAGE_CONFIG['max_entries'],
+                 state_ttl: float = FSM_STORAGE_CONFIG['state_ttl'],
+                 max_conflict_retries: int = FSM_STORAGE_CONFIG['max_conflict_retries'],
+                 max_retry_delay: float = FSM_STORAGE_CONFIG['max_retry_delay']):
+        self.db = db
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.flush_delay = flush_delay
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self.state_ttl = state_ttl
+        self.max_conflict_retries = max_conflict_retries
+        self.max_retry_delay = max_retry_delay
+        self._retry_delay = 0.0
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._dirty: set[str] = set()
+        self._flusher: asyncio.Task | None = None
+        self._stats = {"reads": 0, "writes": 0, "conflicts": 0, "errors": 0}
+
+    async def _load(self, key: str) -> _Entry:
+        entry = self._entries.get(key)
+        if entry is not None and (entry.dirty or time.monotonic() - entry.loaded_at < self.cache_ttl):
+            self._entries.move_to_end(key)
+            return entry
+
+        self._stats["reads"] += 1
+        row = await self.db.get_fsm_state(key)
+        # Пока шёл запрос, сессию могли изменить локально
+        current = self._entries.get(key)
+        if current is not None and current.dirty:
+            return current
+        state, data, version = row if row else (None, {}, 0)
+        entry = self._entries[key] = _Entry(state=state, data=data, version=version,
+                                            base_state=state, base_data=copy.deepcopy(data))
+        self._entries.move_to_end(key)
+        self._evict()
+        return entry
+
+    def _evict(self):
+        for key in list(self._entries):
+            if len(self._entries) <= self.max_entries:
+                break
+            if not self._entries[key].dirty:
+                del self._entries[key]
+
+    def _mark_dirty(self, key: str, entry: _Entry):
+        entry.dirty = True
+        self._dirty.add(key)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self, delay: float | None = None):
+        await asyncio.sleep(self.flush_delay if delay is None else delay)
+        await self.flush()
+
+    async def flush(self, reschedule: bool = True):
+        """
+        Записывает в БД все изменённые сессии. Ошибка одной сессии не останавливает запись остальных,
+        несохранённые сессии повторяются с растущей паузой, не дожидаясь следующего изменения
+        :param reschedule: запланировать повтор, если часть сессий записать не удалось
+        """
+        failed = set()
+        while self._dirty:
+            key = self._dirty.pop()
+            entry = self._entries.get(key)
+            if entry is None or not entry.dirty:
+                continue
+            try:
+                await self._write(key, entry)
+            except Exception as e:
+                self._stats["errors"] += 1
+                logging.warning(f"Не удалось сохранить состояние FSM {key}: {e}")
+                failed.add(key)
+        if not failed:
+            self._retry_delay = 0.0
+            return
+        self._dirty |= failed
+        if not reschedule:
+            return
+        self._retry_delay = min(max(self._retry_delay * 2, self.flush_delay, 1.0), self.max_retry_delay)
+        # flush может выполняться в самой задаче записи, поэтому проверяем и текущую задачу
+        if self._flusher is None or self._flusher.done() or self._flusher is asyncio.current_task():
+            self._flusher = asyncio.create_task(self._flush_later(self._retry_delay))
+
+    async def _write(self, key: str, entry: _Entry):
+        for _ in range(self.max_conflict_retries + 1):
+            state, data = entry.state, copy.deepcopy(entry.data)
+            version = await self.db.save_fsm_state(key, state, data, entry.version)
+            if version is not None:
+                self._stats["writes"] += 1
+                entry.version = version
+                entry.base_state, entry.base_data = state, data
+                entry.loaded_at = time.monotonic()
+                if entry.state == state and entry.data == data:
+                    entry.dirty = False
+                else:
+                    # Сессия изменилась, пока шла запись
+                    self._mark_dirty(key, entry)
+                return
+            self._stats["conflicts"] += 1
+            self._merge(entry, await self.db.get_fsm_state(key))
+        raise RuntimeError("версия сессии меняется слишком часто")
+
+    @staticmethod
+    def _merge(entry: _Entry, row):
+        """Накладывает локальные изменения сессии поверх версии из БД."""
+        remote_state, remote_data, remote_version = row if row else (None, {}, 0)
+        state = entry.state if entry.state != entry.base_state else remote_state
+        data = copy.deepcopy(remote_data)
+        for name in set(entry.base_data) | set(entry.data):
+            if name not in entry.data:
+                data.pop(name, None)
+            elif entry.base_data.get(name, _MISSING) != entry.data[name]:
+                data[name] = entry.data[name]
+        logging.info(f"Сессия FSM изменена другим экземпляром бота, локальные изменения перенесены на версию "
+                     f"{remote_version}")
+        entry.state, entry.data, entry.version = state, data, remote_version
+        entry.base_state, entry.base_data = remote_state, remote_data
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        entry = await self._load(storage_key)
+        entry.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(storage_key, entry)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._load(self.key_builder.build(key))).state
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        storage_key = self.key_builder.build(key)
+        entry = await self._load(storage_key)
+        entry.data = copy.deepcopy(data)
+        self._mark_dirty(storage_key, entry)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return copy.deepcopy((await self._load(self.key_builder.build(key))).data)
+
+    async def cleanup(self) -> int:
+        """
+        Удаляет из БД сессии, брошенные дольше state_ttl
+        :return: число удалённых сессий
+        """
+        return await self.db.delete_idle_fsm_states(self.state_ttl)
+
+    def stats(self) -> dict:
+        return dict(self._stats, cached=len(self._entries), dirty=len(self._dirty))
+
+    async def close(self) -> None:
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        self._dirty.update(key for key, entry in self._entries.items() if entry.dirty)
+        await self.flush(reschedule=False)
+        logging.info(f"Хранилище FSM закрыто: {self.stats()}")
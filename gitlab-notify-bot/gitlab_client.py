@@ -0,0 +1,355 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from typing import Callable
+from collections import OrderedDict
+
+import aiohttp
+from dotenv import load_dotenv
+
+load_dotenv()
+GITLAB_CLIENT_CONFIG = {
+    "timeout": float(os.getenv("GITLAB_TIMEOUT", "30")),
+    "connect_timeout": float(os.getenv("GITLAB_CONNECT_TIMEOUT", "10")),
+    "limit": int(os.getenv("GITLAB_POOL_LIMIT", "20")),
+    "keepalive_timeout": float(os.getenv("GITLAB_KEEPALIVE_TIMEOUT", "60")),
+    "cache_max_entries": int(os.getenv("GITLAB_CACHE_MAX_ENTRIES", "2000")),
+    "cache_max_bytes": int(os.getenv("GITLAB_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+}
+# Максимальный размер страницы списочных методов GitLab API
+MAX_PER_PAGE = 100
+# Размер страницы при чтении новых комментариев задачи
+NOTES_PER_PAGE = min(int(os.getenv("GITLAB_NOTES_PER_PAGE", "20")), MAX_PER_PAGE)
+
+
+def get_headers(token):
+    headers = {
+        'Private-Token': token
+    }
+    return headers
+
+
+class ResponseCache:
+    """
+    LRU-кэш GET-ответов GitLab для условных запросов (ETag / Last-Modified).
+    Ограничен числом записей и суммарным размером тел ответов.
+    Закэшированный JSON отдаётся как есть, вызывающий код не должен его изменять.
+    """
+
+    def __init__(self, max_entries: int = GITLAB_CLIENT_CONFIG['cache_max_entries'],
+                 max_bytes: int = GITLAB_CLIENT_CONFIG['cache_max_bytes']):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        # Каждый запрос учитывается ровно в одном счётчике: hits - 304 с телом из кэша, misses - полный ответ,
+        # refetches - 304 без тела в кэше, после которого запрос повторяется без условных заголовков
+        self.stats = {"hits": 0, "misses": 0, "refetches": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(url: str, params, token: str | None):
+        if isinstance(params, dict):
+            params = params.items()
+        return url, tuple(sorted((str(k), str(v)) for k, v in (params or []))), token
+
+    def conditional_headers(self, key) -> dict:
+        entry = self._entries.get(key)
+        if entry is None:
+            return {}
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def get(self, key):
+        """
+        Возвращает запись после ответа 304 и помечает её как недавно использованную
+        :return: запись или None, если тела ответа в кэше нет (запись вытеснена или не сохранялась)
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry["body"] is None:
+            self.discard(key)
+            self.stats["refetches"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry
+
+    def store(self, key, body, headers, size: int):
+        self.stats["misses"] += 1
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        self.discard(key)
+        if not (etag or last_modified) or size > self.max_bytes:
+            return
+        self._entries[key] = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "body": body,
+            "headers": headers,
+            "size": size,
+        }
+        self._size += size
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted["size"]
+            self.stats["evictions"] += 1
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry["size"]
+
+    def snapshot_stats(self) -> dict:
+        return {**self.stats, "entries": len(self._entries), "bytes": self._size}
+
+
+class GitLabClient:
+    """
+    Асинхронный клиент GitLab API поверх одной долгоживущей aiohttp-сессии.
+    Соединения переиспользуются (keep-alive), у каждого запроса есть таймаут.
+    Методы возвращают разобранный JSON либо None, если запрос не удался.
+    """
+
+    def __init__(self, host: str, token: str,
+                 timeout: float = GITLAB_CLIENT_CONFIG['timeout'],
+                 connect_timeout: float = GITLAB_CLIENT_CONFIG['connect_timeout'],
+                 limit: int = GITLAB_CLIENT_CONFIG['limit'],
+                 keepalive_timeout: float = GITLAB_CLIENT_CONFIG['keepalive_timeout']):
+        self.host = host.rstrip("/") if host else host
+        self.api_url = f"{self.host}/api/v4"
+        self.token = token
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.cache = ResponseCache()
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Сессия создаётся лениво, внутри работающего цикла событий
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers=get_headers(self.token)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _send(self, method: str, path: str, *, expected=(200,), token: str | None = None,
+                    timeout: float | None = None, conditional: bool = True, **kwargs):
+        """
+        :param conditional: отправлять условные заголовки по записи кэша
+        :return: кортеж (разобранный JSON, заголовки ответа) или None
+        """
+        original_kwargs = dict(kwargs)
+        if token is not None:
+            kwargs["headers"] = {**kwargs.get("headers", {}), **get_headers(token)}
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        url = f"{self.api_url}{path}"
+        cache_key = None
+        if method == "GET":
+            cache_key = self.cache.make_key(url, kwargs.get("params"), token)
+            headers = self.cache.conditional_headers(cache_key) if conditional else {}
+            if headers:
+                kwargs["headers"] = {**kwargs.get("headers", {}), **headers}
+        try:
+            async with self.session.request(method, url, **kwargs) as resp:
+                if resp.status == 304 and cache_key is not None:
+                    entry = self.cache.get(cache_key)
+                    if entry is not None:
+                        logging.debug(f"GitLab {method} {path} → 304, ответ из кэша")
+                        return entry["body"], entry["headers"]
+                    if conditional:
+                        # Запись вытеснили, пока шёл запрос: повторяем его один раз без условных заголовков
+                        logging.debug(f"GitLab {method} {path} → 304 без тела в кэше, повторный запрос")
+                        resp.release()
+                        return await self._send(method, path, expected=expected, token=token, timeout=timeout,
+                                                conditional=False, **original_kwargs)
+                if resp.status not in expected:
+                    text = await resp.text()
+                    logging.warning(f"GitLab {method} {path} → {resp.status} {text[:500]}")
+                    return None
+                raw = await resp.read()
+                result = json.loads(raw) if raw else None
+                logging.debug(f"GitLab {method} {path} → {resp.status}")
+                if cache_key is not None:
+                    self.cache.store(cache_key, result, resp.headers.copy(), len(raw))
+                return result, resp.headers
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"GitLab {method} {path}: ошибка запроса {e!r}")
+            return None
+
+    async def request(self, method: str, path: str, **kwargs):
+        """
+        Выполняет запрос к GitLab API
+        :param method: HTTP-метод
+        :param path: путь относительно /api/v4 (например, /projects/1/issues)
+        :param expected: коды ответа, считающиеся успешными
+        :param token: токен пользователя вместо токена бота
+        :param timeout: таймаут запроса в секундах вместо общего
+        :return: разобранный JSON ответа или None
+        """
+        response = await self._send(method, path, **kwargs)
+        return response[0] if response is not None else None
+
+    async def paginate(self, path: str, params: list | dict | None = None, per_page: int = MAX_PER_PAGE,
+                       until: Callable[[list], bool] | None = None, **kwargs) -> list | None:
+        """
+        Собирает страницы списочного метода, следуя заголовку X-Next-Page
+        :param params: параметры запроса, для повторяющихся ключей (iids[]) - список пар
+        :param until: условие остановки, проверяется для каждой полученной страницы
+        :return: объединённый список элементов или None, если какая-либо страница не получена
+        """
+        params = list(params.items()) if isinstance(params, dict) else list(params or [])
+        items = []
+        page = 1
+        while page:
+            response = await self._send("GET", path,
+                                        params=params + [("per_page", per_page), ("page", page)], **kwargs)
+            if response is None:
+                return None
+            body, headers = response
+            items.extend(body)
+            if until is not None and until(body):
+                break
+            next_page = headers.get("X-Next-Page")
+            page = int(next_page) if next_page else None
+        return items
+
+    async def get_users(self, params: dict | None = None, until: Callable[[list], bool] | None = None):
+        """
+        Получаем список пользователей GitLab со всех страниц
+        :param until: условие остановки постраничного чтения
+        :return: список словарей с данными пользователей
+        """
+        return await self.paginate("/users", params, until=until)
+
+    async def create_personal_access_token(self, params: dict):
+        """
+        Создание токена доступа пользователю
+        :param params: Словарь: user_id - id пользователя, name - название токена, scopes[] - права доступа,
+        :return: Результат создания токена
+        """
+        return await self.request("POST", f"/users/{params['user_id']}/personal_access_tokens",
+                                  params=params, expected=(201,))
+
+    async def revoke_personal_access_token(self, token_id: int) -> bool:
+        """
+        Отзыв токена доступа, например созданного для пользователя, которого не удалось завести в БД
+        :return: True, если GitLab отозвал токен
+        """
+        return await self._send("DELETE", f"/personal_access_tokens/{token_id}", expected=(204,)) is not None
+
+    async def get_projects(self, token: str | None = None):
+        """
+        Получить список проектов, доступных пользователю
+        :param token: токен пользователя для запроса
+        :return: список проектов
+        """
+        return await self.request("GET", "/projects", token=token)
+
+    async def create_issue(self, project_id: int, params: dict) -> dict | None:
+        return await self.request("POST", f"/projects/{project_id}/issues", params=params, expected=(201,))
+
+    async def get_issue(self, project_id: int, issue_iid: int) -> dict | None:
+        return await self.request("GET", f"/projects/{project_id}/issues/{issue_iid}")
+
+    async def list_issues(self, project_id: int, params: list | dict | None = None) -> list | None:
+        return await self.paginate(f"/projects/{project_id}/issues", params)
+
+    async def get_issues_by_iids(self, project_id: int, iids: list[int]) -> dict[int, dict] | None:
+        """
+        Получает задачи проекта пачками по MAX_PER_PAGE iid за запрос
+        :return: словарь iid -> задача или None, если GitLab не ответил. Удалённых задач в словаре нет
+        """
+        issues = {}
+        iids = sorted(set(iids))
+        for i in range(0, len(iids), MAX_PER_PAGE):
+            batch = iids[i:i + MAX_PER_PAGE]
+            found = await self.list_issues(project_id, [("iids[]", iid) for iid in batch])
+            if found is None:
+                return None
+            issues.update((issue["iid"], issue) for issue in found)
+        return issues
+
+    async def update_issue(self, project_id: int, issue_iid: int, payload: dict) -> dict | None:
+        return await self.request("PUT", f"/projects/{project_id}/issues/{issue_iid}", json=payload)
+
+    async def get_notes(self, project_id: int, issue_iid: int, params: dict | None = None) -> list | None:
+        return await self.request("GET", f"/projects/{project_id}/issues/{issue_iid}/notes", params=params)
+
+    async def get_notes_since(self, project_id: int, issue_iid: int, last_note_id: int,
+                              per_page: int = NOTES_PER_PAGE) -> list | None:
+        """
+        Читает комментарии от новых к старым и останавливается на странице, где встретился last_note_id,
+        поэтому число запросов зависит от числа новых комментариев, а не от длины обсуждения
+        :return: комментарии от старых к новым: все новее last_note_id и остаток последней прочитанной страницы,
+                 то есть не меньше per_page последних комментариев; None, если GitLab не ответил
+        """
+        notes = await self.paginate(f"/projects/{project_id}/issues/{issue_iid}/notes",
+                                    {"order_by": "created_at", "sort": "desc"}, per_page=per_page,
+                                    until=lambda page: any(note["id"] <= last_note_id for note in page))
+        if notes is None:
+            return None
+        notes.reverse()
+        return notes
+
+    async def create_note(self, project_id: int, issue_iid: int, body: str) -> dict | None:
+        return await self.request("POST", f"/projects/{project_id}/issues/{issue_iid}/notes",
+                                  json={"body": body}, expected=(201,))
+
+    async def upload_file(self, project_id: int, file_name: str, file_data, mime_type: str | None = None) -> dict | None:
+        """
+        Загрузка файла в проект
+        :return: ответ GitLab, ключ markdown содержит ссылку для вставки в комментарий
+        """
+        form = aiohttp.FormData()
+        form.add_field("file", file_data, filename=file_name,
+                       content_type=mime_type or "application/octet-stream")
+        return await self.request("POST", f"/projects/{project_id}/uploads", data=form, expected=(201,))
+
+    async def stream_download(self, path: str, fileobj, max_bytes: int | None = None,
+                              chunk_size: int = 64 * 1024):
+        """
+        Потоково скачивает вложение по пути вида /uploads/... в файловый объект, не держа его целиком в памяти
+        :param fileobj: файл, открытый на запись в бинарном режиме
+        :param max_bytes: ограничение размера, превышение прерывает загрузку
+        :return: кортеж (Content-Type, размер, sha256 содержимого) или None
+        """
+        url = f"{self.host}{path}"
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async with self.session.get(url) as resp:
+                if resp.status != 200:
+                    logging.warning(f"GitLab GET {path} → {resp.status}")
+                    return None
+                if max_bytes is not None and (resp.content_length or 0) > max_bytes:
+                    logging.warning(f"GitLab GET {path}: файл {resp.content_length} байт больше лимита {max_bytes}")
+                    return None
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        logging.warning(f"GitLab GET {path}: файл больше лимита {max_bytes} байт")
+                        return None
+                    digest.update(chunk)
+                    fileobj.write(chunk)
+                return resp.headers.get("Content-Type", ""), size, digest.hexdigest()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"GitLab GET {path}: ошибка загрузки {e!r}")
+            return None
@@ -5,31 +5,37 @@ from dotenv import load_dotenv
 load_dotenv()
 import re
 import datetime
-from collections import defaultdict
+import time
+import weakref
 from typing import Callable, Dict, Any, Awaitable
 
-import requests
 from aiogram import Bot, Router, Dispatcher, types, F, BaseMiddleware
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, BufferedInputFile, ReplyKeyboardMarkup, KeyboardButton, Message, TelegramObject, InputMediaPhoto, InputMediaDocument
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, Message, TelegramObject
 
 
 from aiogram.types import ChatMemberUpdated
 
-from db import Database
+from db import Database, TRACKED_ISSUES_CHANNEL, ISSUE_SUBSCRIPTIONS_CHANNEL
+from async_db import AsyncDatabase, DatabaseListener
+from gitlab_client import GitLabClient
+from messages import closed_issue_text, closed_issue_keyboard
+from sweep import IssueSweep, SweepContext
+from attachments import AttachmentRelay, GitLabUploader, uploaded_markdown
+from delivery import Priority, delivery_priority, setup_outbox
+from blob_store import BlobStore, BlobTrackingStorage
+from fsm_storage import PostgresStorage
+from user_directory import GitLabUserDirectory, USER_DIRECTORY_CONFIG, provision_user, provision_known_users
 
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10 MB
 MAX_FILES = 10
-
-def get_headers(token):
-    headers = {
-        'Private-Token': token
-    }
-    return headers
+# Сколько файлов альбома скачивается из Telegram одновременно
+TELEGRAM_DOWNLOAD_CONCURRENCY = int(os.getenv("TELEGRAM_DOWNLOAD_CONCURRENCY", "4"))
+# Снимок задачи, не подтверждённый обходом дольше этого срока, показывается с пометкой
+ISSUE_SNAPSHOT_STALE_AFTER = float(os.getenv("ISSUE_SNAPSHOT_STALE_AFTER", "900"))
 
 load_dotenv()
 
@@ -46,78 +52,29 @@ DB_CONFIG = {
     "port": os.getenv("DB_PORT"),
     "table_name": os.getenv("DB_TABLE_NAME")
 }
-HEADERS = get_headers(GITLAB_TOKEN)
 ISSUE_TYPE_NAMES = ["Задача", "Проблема"]
 
 bot = Bot(token=TELEGRAM_TOKEN,default=DefaultBotProperties(parse_mode="HTML"))
+outbox = setup_outbox(bot)
 keyboard_to_delete = types.ReplyKeyboardRemove()
 router = Router()
-dp = Dispatcher(storage=MemoryStorage())
-dp.include_router(router)
 db = Database(
     dbname=DB_CONFIG['dbname'],
     user=DB_CONFIG['user'],
     password=DB_CONFIG['password'],
     host=DB_CONFIG['host'],
     port=DB_CONFIG['port'])
-
-def get_gitlab_users():
-    """
-    Получаем пользователя из GitLab по telegram_id
-    :return: возвращает ответ по запросу
-    """
-    url = f'{GITLAB_HOST}/api/v4/users'
-    response = requests.get(url, headers=HEADERS)
-    logging.debug(f"Получение списка пользователей Gitlab: {response} {response.json()}")
-    if response.status_code == 200:
-        return response.json()
-    return None
-
-def get_user_from_users_list(users: list, user_id: int):
-    """
-    :param users: Список словарей с данными пользователя
-    :param user_id: Идентификатор телеграма пользователя
-    :return: None, если совпадений не найдено, иначе - словарь с данными пользователя
-    """
-    user_id = str(user_id)
-    if users:
-        for user in users:
-            if user.get('skype') == user_id:
-                return user
-    else:
-        return None
-
-def create_personal_access_token(params: dict):
-    """
-    Создание токена доступа пользователю
-    :param params: Словарь: user_id - id пользователя, name - название токена, scopes[] - права доступа,
-    :return: Результат создания токена
-    """
-    url = f'{GITLAB_HOST}/api/v4/users/{params['user_id']}/personal_access_tokens'
-    response = requests.post(url, headers=HEADERS, params=params)
-    logging.debug(f"{response} {response.json()}")
-    if response.status_code == 201:
-        return response.json()
-    return None
-
-def get_gitlab_projects(headers):
-    """
-    Получить список проектов, доступных пользователю
-    :param headers: Заголовок с токеном пользователя для запроса
-    :return: список проектов
-    """
-    url = f'{GITLAB_HOST}/api/v4/projects'
-    response = requests.get(url, headers=headers)
-    logging.debug(f"{response} {response.json()}")
-    if response.status_code == 200:
-        return response.json()
-    return None
-
-def create_gitlab_issue(project_id: int, params: dict) -> dict | None:
-    url = f"{GITLAB_HOST}/api/v4/projects/{project_id}/issues"
-    r = requests.post(url, headers=HEADERS, params=params)
-    logging.debug(f"Create issue → {r.status_code} {r.text}")
-    return r.json() if r.status_code == 201 else None
+adb = AsyncDatabase(db)
+blob_store = BlobStore()
+fsm_storage = PostgresStorage(adb)
+dp = Dispatcher(storage=BlobTrackingStorage(fsm_storage, blob_store))
+dp.include_router(router)
+gitlab = GitLabClient(GITLAB_HOST, GITLAB_TOKEN)
+relay = AttachmentRelay(gitlab, adb)
+uploader = GitLabUploader(gitlab, blob_store)
+user_directory = GitLabUserDirectory(gitlab)
+sweep = IssueSweep(SweepContext(bot=bot, db=adb, gitlab=gitlab, relay=relay))
+db_listener = DatabaseListener(db, [TRACKED_ISSUES_CHANNEL, ISSUE_SUBSCRIPTIONS_CHANNEL])
 
 def make_row_keyboard(items: list[str], add_back_button: bool = True) -> ReplyKeyboardMarkup:
     buttons = [KeyboardButton(text=item) for item in items]
@@ -126,53 +83,155 @@ def make_row_keyboard(items: list[str], add_back_button: bool = True) -> ReplyKe
     keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
-def get_user(user_id: int, telegram_chat_id: int):
-    user_db = db.get_user_by_telegram_id(user_id)
+async def get_user(user_id: int, telegram_chat_id: int):
+    user_db = await adb.get_user_by_telegram_id(user_id)
     if user_db:
         logging.info(f"Пользователь {user_id} в БД найден")
         return user_db
-    else:
-        logging.info(f"Пользователь {user_id} в БД не найден")
-        gitlab_users = get_gitlab_users()
-        if gitlab_users:
-            gitlab_user = get_user_from_users_list(gitlab_users, user_id)
-            if gitlab_user:
-                params = {
-                    'user_id': gitlab_user['id'],
-                    'name': 'GitLab & Telegram Bot',
-                    'scopes[]': 'api'
-                }
-                user_token_gitlab = create_personal_access_token(params)
-                if user_token_gitlab:
-
-                    logging.info(f"Пользователь {user_id} в Gitlab найден {gitlab_user}")
-
-                    user_id_gitlab = gitlab_user['id']
-                    user_username_gitlab = gitlab_user['username']
-
-                    user_db = db.create_user(telegram_id=user_id, gitlab_id=user_id_gitlab,
-                                             gitlab_login=user_username_gitlab,
-                                             gitlab_token=user_token_gitlab['token'],
-                                             telegram_chat_id=telegram_chat_id)
-                    if user_db:
-                        logging.info(f"Пользователь {user_id} создан в БД {user_db}")
-                        return user_db
-                    else:
-                        logging.warning(f"Пользователь {user_id} не создан в БД")
-                else:
-                    logging.warning(
-                        f"Для пользователя {user_id} не создан токен Gitlab и создание пользователя в БД прекращено")
-            else:
-                logging.info(f"Пользователь {user_id} в Gitlab не найден {gitlab_user}")
-        else:
-            logging.warning(f"Не удалось получить список пользователей Gitlab")
+
+    logging.info(f"Пользователь {user_id} в БД не найден")
+    gitlab_user = await user_directory.find(user_id)
+    if not gitlab_user:
+        logging.info(f"Пользователь {user_id} в Gitlab не найден")
         return None
+    logging.info(f"Пользователь {user_id} в Gitlab найден {gitlab_user}")
+    return await provision_user(gitlab, adb, gitlab_user, user_id, telegram_chat_id)
+
+
+async def save_telegram_file(state: FSMContext, file_obj) -> dict:
+    """
+    Скачивает файл из Telegram в хранилище файлов, в данные FSM попадает только ссылка на него
+    :param file_obj: Document или PhotoSize
+    :return: описание файла {'file_name', 'blob', 'size', 'mime_type'}
+    """
+    file_info = await bot.get_file(file_obj.file_id)
+    writer = blob_store.writer()
+    try:
+        await bot.download_file(file_info.file_path, destination=writer, seek=False)
+    except Exception:
+        writer.abort()
+        raise
+    blob_hash, size = blob_store.commit(state.key, writer)
+    return {
+        'file_name': getattr(file_obj, 'file_name', None) or f"photo_{file_obj.file_id}.jpg",
+        'blob': blob_hash,
+        'size': size,
+        'mime_type': getattr(file_obj, 'mime_type', None) or "image/jpeg"
+    }
+
+
+download_semaphore = asyncio.Semaphore(TELEGRAM_DOWNLOAD_CONCURRENCY)
+# Блокировки сессий FSM: файлы одной сессии приходят разными сообщениями и обрабатываются параллельно
+_session_locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+def session_lock(state: FSMContext) -> asyncio.Lock:
+    lock = _session_locks.get(state.key)
+    if lock is None:
+        lock = _session_locks[state.key] = asyncio.Lock()
+    return lock
+
+async def add_session_files(state: FSMContext, field: str, stored: list[dict]) -> tuple[list[dict], int]:
+    """
+    Дописывает скачанные файлы в список field данных сессии. Чтение и запись данных идут под блокировкой
+    сессии, поэтому параллельные сообщения с файлами не затирают друг друга; лимит MAX_FILES проверяется
+    по актуальному списку, файлы сверх него освобождаются
+    :return: кортеж (список файлов сессии, число файлов сверх лимита)
+    """
+    async with session_lock(state):
+        files = (await state.get_data()).get(field) or []
+        free = max(MAX_FILES - len(files), 0)
+        files = files + stored[:free]
+        await state.update_data({field: files})
+    kept = {f['blob'] for f in files}
+    for rejected in stored[free:]:
+        # Тот же файл мог быть принят раньше, его не трогаем
+        if rejected['blob'] not in kept:
+            blob_store.discard(state.key, rejected['blob'])
+    return files, len(stored[free:])
+
+async def upload_session_files(message: types.Message, project_id: int, files: list[dict]) -> list[str]:
+    """
+    Загружает файлы сессии в GitLab и сообщает пользователю, какие загрузить не удалось
+    :return: markdown-ссылки загруженных файлов
+    """
+    uploads = await uploader.upload_all(project_id, files)
+    failed = [f['file_name'] for f, upload in zip(files, uploads) if not upload]
+    if failed:
+        await message.answer(f"⚠️ Не удалось загрузить: {', '.join(failed)}")
+    return uploaded_markdown(uploads)
+
+def file_display_name(file_obj) -> str:
+    return getattr(file_obj, 'file_name', None) or file_obj.file_id
+
+async def save_album_files(state: FSMContext, album: list[types.Message], files: list[dict]):
+    """
+    Отбирает файлы альбома и скачивает их одновременно.
+    Файлы, размер которых Telegram уже сообщил и он больше MAX_FILE_SIZE, и файлы сверх MAX_FILES не скачиваются.
+    :param files: уже принятые файлы сессии
+    :return: кортеж (принятые файлы, имена слишком больших файлов, число файлов сверх лимита)
+    """
+    too_large = []
+    candidates = []
+    for msg in album:
+        if not (msg.document or msg.photo):
+            continue
+        file_obj = msg.document or msg.photo[-1]
+        if file_obj.file_size and file_obj.file_size > MAX_FILE_SIZE:
+            too_large.append(file_display_name(file_obj))
+        else:
+            candidates.append(file_obj)
+
+    free = max(MAX_FILES - len(files), 0)
+    accepted, over_limit = candidates[:free], max(len(candidates) - free, 0)
+
+    async def download(file_obj):
+        async with download_semaphore:
+            return await save_telegram_file(state, file_obj)
+
+    results = await asyncio.gather(*(download(file_obj) for file_obj in accepted), return_exceptions=True)
+    stored = []
+    for file_obj, result in zip(accepted, results):
+        if isinstance(result, Exception):
+            logging.warning(f"Не удалось скачать файл {file_display_name(file_obj)}: {result}")
+            continue
+        # Telegram сообщает размер не для всех файлов, проверяем и фактический
+        if result['size'] > MAX_FILE_SIZE:
+            blob_store.discard(state.key, result['blob'])
+            too_large.append(file_display_name(file_obj))
+            continue
+        stored.append(result)
+    return stored, too_large, over_limit
+
+
+class _Album:
+    def __init__(self, handler: Callable, data: Dict[str, Any]):
+        self.handler = handler
+        self.data = data
+        self.messages: list[Message] = []
+        self.started = time.monotonic()
+        self.last_part = self.started
+        self.max_gap = 0.0
+        self.timer: asyncio.TimerHandle | None = None
 
 
 class AlbumMiddleware(BaseMiddleware):
-    def __init__(self, latency: float = 0.3):
+    """
+    Собирает части альбома (сообщения с одним media_group_id) и вызывает обработчик один раз на весь альбом.
+    У каждого альбома один таймер, который перезапускается с каждой новой частью; пауза тишины
+    подстраивается под интервалы между частями, но не превышает max_latency.
+    Альбом отправляется в обработчик сразу, если в нём max_parts частей, если он собирается дольше
+    stale_after секунд или если открыто max_groups альбомов и нужно место под новый.
+    """
+
+    def __init__(self, latency: float = 0.3, max_latency: float = 1.5, max_parts: int = 10,
+                 max_groups: int = 200, stale_after: float = 10.0):
         self.latency = latency
-        self.albums = defaultdict(list)
+        self.max_latency = max_latency
+        self.max_parts = max_parts
+        self.max_groups = max_groups
+        self.stale_after = stale_after
+        self.albums: dict[str, _Album] = {}
+        self._tasks: set[asyncio.Task] = set()
 
     async def __call__(
             self,
@@ -184,16 +243,48 @@ class AlbumMiddleware(BaseMiddleware):
         if not event.media_group_id:
             return await handler(event, data)
 
-        # Добавляем сообщение в альбом
-        self.albums[event.media_group_id].append(event)
-
-        # Задержка для сбора всего альбома
-        await asyncio.sleep(self.latency)
+        group_id = event.media_group_id
+        album = self.albums.get(group_id)
+        if album is None:
+            while len(self.albums) >= self.max_groups:
+                self._flush(next(iter(self.albums)))
+            album = self.albums[group_id] = _Album(handler, data)
+
+        now = time.monotonic()
+        if album.messages:
+            album.max_gap = max(album.max_gap, now - album.last_part)
+        album.last_part = now
+        album.messages.append(event)
+
+        if len(album.messages) >= self.max_parts or now - album.started >= self.stale_after:
+            self._flush(group_id)
+            return None
+
+        # Обработчик вызовет таймер, текущее сообщение не ждёт окончания альбома
+        if album.timer is not None:
+            album.timer.cancel()
+        quiet = min(max(self.latency, album.max_gap * 2), self.max_latency)
+        album.timer = asyncio.get_running_loop().call_later(quiet, self._flush, group_id)
+        return None
 
-        # Если это последнее сообщение в альбоме
-        if event.media_group_id in self.albums:
-            data["album"] = self.albums.pop(event.media_group_id)
-            return await handler(event, data)
+    def _flush(self, group_id: str):
+        album = self.albums.pop(group_id, None)
+        if album is None:
+            return
+        if album.timer is not None:
+            album.timer.cancel()
+        messages = sorted(album.messages, key=lambda m: m.message_id)
+        task = asyncio.create_task(self._handle(album, messages))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _handle(album: _Album, messages: list[Message]):
+        album.data["album"] = messages
+        try:
+            await album.handler(messages[0], album.data)
+        except Exception as e:
+            logging.exception(f"Ошибка обработки альбома {messages[0].media_group_id}: {e}")
 
 album_middleware = AlbumMiddleware()
 dp.message.middleware(album_middleware)
@@ -243,49 +334,31 @@ async def collect_attach_media_group(
     data = await state.get_data()
     files = data.get('attach_files', [])
 
-    for msg in album:
-        file_obj = msg.document or msg.photo[-1]
-        file_info = await bot.get_file(file_obj.file_id)
-        downloaded = await bot.download_file(file_info.file_path)
-        content = downloaded.read()
-
-        if len(content) > MAX_FILE_SIZE:
-            await msg.answer(f"🚫 Файл {getattr(file_obj, 'file_name', file_obj.file_id)} слишком большой")
-            continue
-        if len(files) >= MAX_FILES:
-            await msg.answer("🚫 Достигнут лимит файлов")
-            break
-
-        files.append({
-            'file_name': getattr(file_obj, 'file_name', f"file_{file_obj.file_id}"),
-            'file_data': content,
-            'mime_type': file_obj.mime_type
-        })
-
-    await state.update_data(attach_files=files)
-    await message.answer(f"📥 Принято {len(album)} файлов из альбома")
+    stored, too_large, over_limit = await save_album_files(state, album, files)
+    _, rejected = await add_session_files(state, 'attach_files', stored)
+    for name in too_large:
+        await message.answer(f"🚫 Файл {name} слишком большой")
+    if over_limit or rejected:
+        await message.answer("🚫 Достигнут лимит файлов")
+    await message.answer(f"📥 Принято {len(stored) - rejected} файлов из альбома")
 
 @router.message(StateFilter(AttachFiles.sending), F.document | F.photo)
 async def collect_attach_files(message: types.Message, state: FSMContext):
     data = await state.get_data()
     files = data['attach_files']
     file_obj = message.document or message.photo[-1]
-    file_info = await bot.get_file(file_obj.file_id)
-    downloaded = await bot.download_file(file_info.file_path)
-    content = downloaded.read()
-
-    if len(content) > MAX_FILE_SIZE:
-        return await message.answer(f"🚫 Файл слишком большой (макс {MAX_FILE_SIZE//1024//1024} MB)")
     if len(files) >= MAX_FILES:
         return await message.answer(f"🚫 Максимум {MAX_FILES} файлов")
+    stored = await save_telegram_file(state, file_obj)
+
+    if stored['size'] > MAX_FILE_SIZE:
+        blob_store.discard(state.key, stored['blob'])
+        return await message.answer(f"🚫 Файл слишком большой (макс {MAX_FILE_SIZE//1024//1024} MB)")
 
-    files.append({
-        'file_name': getattr(file_obj, 'file_name', f"file_{file_obj.file_id}"),
-        'file_data': content,
-        'mime_type': file_obj.mime_type
-    })
-    await state.update_data(attach_files=files)
-    await message.answer(f"📥 Принято: {files[-1]['file_name']}")
+    _, rejected = await add_session_files(state, 'attach_files', [stored])
+    if rejected:
+        return await message.answer(f"🚫 Максимум {MAX_FILES} файлов")
+    await message.answer(f"📥 Принято: {stored['file_name']}")
 
 @router.message(StateFilter(AttachFiles.sending), F.text == 'Готово')
 async def finish_attach_files(message: types.Message, state: FSMContext):
@@ -294,25 +367,12 @@ async def finish_attach_files(message: types.Message, state: FSMContext):
     issue_iid = data['issue_iid']
     files = data.get('attach_files', [])
 
-    headers = HEADERS
-
-    markdowns = []
-    for f in files:
-        resp = requests.post(
-            f"{GITLAB_HOST}/api/v4/projects/{project_id}/uploads",
-            headers=headers,
-            files={'file': (f['file_name'], f['file_data'], f['mime_type'])}
-        )
-        if resp.status_code == 201:
-            markdowns.append(resp.json()['markdown'])
-        else:
-            await message.answer(f"⚠️ Ошибка загрузки {f['file_name']}")
+    markdowns = await upload_session_files(message, project_id, files)
 
     if markdowns:
         body = "<b>Прикрепленные файлы:</b>\n" + "\n".join(markdowns)
-        notes_url = f"{GITLAB_HOST}/api/v4/projects/{project_id}/issues/{issue_iid}/notes"
-        note_resp = requests.post(notes_url, headers=headers, json={'body': body})
-        if note_resp.status_code == 201:
+        note = await gitlab.create_note(project_id, issue_iid, body)
+        if note:
             await message.answer("✅ Файлы успешно прикреплены.", parse_mode='HTML')
         else:
             await message.answer("❌ Не удалось добавить файлы к обращению.")
@@ -342,7 +402,7 @@ async def reopen_issue_callback(callback: types.CallbackQuery, state: FSMContext
     issue_iid = int(issue_iid)
     await state.update_data(project_id=project_id, issue_iid=issue_iid)
 
-    db.add_subscription(callback.from_user.id, project_id, issue_iid)
+    await adb.add_subscription(callback.from_user.id, project_id, issue_iid)
 
     await state.set_state(ReopenIssue.enter_comment)
     await callback.message.answer("✍️ Введите комментарий, чтобы вернуть обращение на доработку:")
@@ -353,22 +413,18 @@ async def collect_reopen_files(message: types.Message, state: FSMContext):
     data = await state.get_data()
     files = data['attach_files']
     file_obj = message.document or message.photo[-1]
-    file_info = await bot.get_file(file_obj.file_id)
-    downloaded = await bot.download_file(file_info.file_path)
-    content = downloaded.read()
-
-    if len(content) > MAX_FILE_SIZE:
-        return await message.answer(f"🚫 Файл слишком большой (макс {MAX_FILE_SIZE//1024//1024} MB)")
     if len(files) >= MAX_FILES:
         return await message.answer(f"🚫 Максимум {MAX_FILES} файлов")
+    stored = await save_telegram_file(state, file_obj)
 
-    files.append({
-        'file_name': getattr(file_obj, 'file_name', f"file_{file_obj.file_id}"),
-        'file_data': content,
-        'mime_type': file_obj.mime_type
-    })
-    await state.update_data(attach_files=files)
-    await message.answer(f"📥 Принято: {files[-1]['file_name']}")
+    if stored['size'] > MAX_FILE_SIZE:
+        blob_store.discard(state.key, stored['blob'])
+        return await message.answer(f"🚫 Файл слишком большой (макс {MAX_FILE_SIZE//1024//1024} MB)")
+
+    _, rejected = await add_session_files(state, 'attach_files', [stored])
+    if rejected:
+        return await message.answer(f"🚫 Максимум {MAX_FILES} файлов")
+    await message.answer(f"📥 Принято: {stored['file_name']}")
 
 @router.message(StateFilter(ReopenIssue.add_files), F.text == 'Готово')
 async def finish_reopen(message: types.Message, state: FSMContext):
@@ -378,40 +434,29 @@ async def finish_reopen(message: types.Message, state: FSMContext):
     comment = data["comment_text"]
     files = data.get("attach_files", [])
 
-    headers = HEADERS
-
-    markdowns = []
-    for f in files:
-        resp = requests.post(
-            f"{GITLAB_HOST}/api/v4/projects/{project_id}/uploads",
-            headers=headers,
-            files={'file': (f['file_name'], f['file_data'], f['mime_type'])}
-        )
-        if resp.status_code == 201:
-            markdowns.append(resp.json()['markdown'])
+    markdowns = await upload_session_files(message, project_id, files)
 
     body = comment
     if markdowns:
         body += "\n\n<b>Прикреплённые файлы:</b>\n" + "\n".join(markdowns)
 
-    notes_url = f"{GITLAB_HOST}/api/v4/projects/{project_id}/issues/{issue_iid}/notes"
-    note_resp = requests.post(notes_url, headers=headers, json={"body": body})
-    if note_resp.status_code != 201:
+    note = await gitlab.create_note(project_id, issue_iid, body)
+    if not note:
         await message.reply("❌ Не удалось отправить комментарий с вложениями.")
         await state.clear()
         return
 
-    issue_url = f"{GITLAB_HOST}/api/v4/projects/{project_id}/issues/{issue_iid}"
-
     payload = {"state_event": "reopen",
                "labels": "На доработке"}
 
-    reopen_resp = requests.put(issue_url, headers=headers, json=payload)
+    reopened = await gitlab.update_issue(project_id, issue_iid, payload)
 
-    if reopen_resp.status_code != 200:
+    if not reopened:
         await message.reply("❌ Не удалось вернуть обращение на доработку.")
     else:
-        db.mark_issue_unnotified(project_id, issue_iid)
+        await sweep.ctx.state.forget(project_id, issue_iid, "notified", "last_labels")
+        await adb.mark_issue_unnotified(project_id, issue_iid)
+        await adb.update_last_labels(project_id, issue_iid, ["На доработке"])
     await state.clear()
 
 @router.message(StateFilter(CommentIssue.add_files), F.document | F.photo)
@@ -419,19 +464,16 @@ async def collect_comment_files(message: types.Message, state: FSMContext):
     data = await state.get_data()
     files = data['attach_files']
     file_obj = message.document or message.photo[-1]
-    file_info = await bot.get_file(file_obj.file_id)
-    content = (await bot.download_file(file_info.file_path)).read()
-    if len(content) > MAX_FILE_SIZE:
-        return await message.answer("🚫 Файл слишком большой")
     if len(files) >= MAX_FILES:
         return await message.answer("🚫 Достигнут лимит файлов")
-    files.append({
-        'file_name': getattr(file_obj, 'file_name', f"file_{file_obj.file_id}"),
-        'file_data': content,
-        'mime_type': file_obj.mime_type
-    })
-    await state.update_data(attach_files=files)
-    await message.answer(f"📥 Принято: {files[-1]['file_name']}")
+    stored = await save_telegram_file(state, file_obj)
+    if stored['size'] > MAX_FILE_SIZE:
+        blob_store.discard(state.key, stored['blob'])
+        return await message.answer("🚫 Файл слишком большой")
+    _, rejected = await add_session_files(state, 'attach_files', [stored])
+    if rejected:
+        return await message.answer("🚫 Достигнут лимит файлов")
+    await message.answer(f"📥 Принято: {stored['file_name']}")
 
 @router.message(StateFilter(CommentIssue.add_files), F.text == 'Готово')
 async def finish_comment(message: types.Message, state: FSMContext):
@@ -440,37 +482,32 @@ async def finish_comment(message: types.Message, state: FSMContext):
     issue_iid = data["issue_iid"]
     comment = data["comment_text"]
     files = data.get("attach_files", [])
-    headers = HEADERS
-
-    markdowns = []
-    for f in files:
-        resp = requests.post(
-            f"{GITLAB_HOST}/api/v4/projects/{project_id}/uploads",
-            headers=headers,
-            files={'file': (f['file_name'], f['file_data'], f['mime_type'])}
-        )
-        if resp.status_code == 201:
-            markdowns.append(resp.json()['markdown'])
+
+    markdowns = await upload_session_files(message, project_id, files)
 
     body = comment
     if markdowns:
         body += "\n\n<b>Прикреплённые файлы:</b>\n" + "\n".join(markdowns)
 
-    notes_url = f"{GITLAB_HOST}/api/v4/projects/{project_id}/issues/{issue_iid}/notes"
-    note_resp = requests.post(notes_url, headers=headers, json={"body": body})
-    if note_resp.status_code != 201:
+    note = await gitlab.create_note(project_id, issue_iid, body)
+    if not note:
         await message.reply("❌ Не удалось отправить комментарий с вложениями.")
     else:
         await message.reply("✅ Комментарий добавлен к обращению.")
     await state.clear()
 
-def notify_issue_updated(project_id: int, issue_iid: int, message_text: str):
-    subscribers = db.get_subscribers(project_id, issue_iid)
-    for telegram_id in subscribers:
-        try:
-            asyncio.create_task(bot.send_message(chat_id=telegram_id, text=message_text))
-        except Exception as e:
-            logging.warning(f"Failed to notify user {telegram_id}: {e}")
+async def notify_issue_updated(project_id: int, issue_iid: int, message_text: str):
+    subscribers = await adb.get_subscribers(project_id, issue_iid)
+    token = delivery_priority.set(Priority.BULK)
+    try:
+        results = await asyncio.gather(
+            *(bot.send_message(chat_id=telegram_id, text=message_text) for telegram_id in subscribers),
+            return_exceptions=True)
+    finally:
+        delivery_priority.reset(token)
+    for telegram_id, result in zip(subscribers, results):
+        if isinstance(result, Exception):
+            logging.warning(f"Failed to notify user {telegram_id}: {result}")
 
 async def show_issue_add_files(message: types.Message, state: FSMContext):
     await message.reply(text=f'Прикрепите вложения', reply_markup=make_row_keyboard(['Продолжить']))
@@ -481,103 +518,39 @@ async def show_issue_select_description(message: types.Message, state: FSMContex
 
 @router.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
-    rows = db.get_all_tracked_issues()
-    for project_id, issue_iid, chat_id, last_known, _ in rows:
-        if chat_id != message.chat.id:
+    for snap in await adb.get_chat_issue_snapshots(message.chat.id):
+        snap = await load_snapshot(snap)
+        if snap is None:
             continue
+        project_id, issue_iid = snap["project_id"], snap["issue_iid"]
 
-        issue_url = f"{GITLAB_HOST}/api/v4/projects/{project_id}/issues/{issue_iid}"
-        resp = requests.get(issue_url, headers=HEADERS)
-        if resp.status_code != 200:
-            continue
-        issue = resp.json()
-
-        if issue["state"] == "closed":
-            closed_at = issue.get("closed_at")
-            closed_dt = None
-            if closed_at:
-                closed_dt = datetime.datetime.fromisoformat(closed_at.rstrip("Z"))
-
-            notes = requests.get(
-                f"{issue_url}/notes",
-                params={"order_by": "created_at", "sort": "desc"},
-                headers=HEADERS
-            ).json()
-
-            assignees = issue.get("assignees") or []
-            if assignees:
-                assignee = assignees[0]
-                assignee_id = assignee["id"]
-                assignee_name = assignee.get("name", "—")
-            else:
-                single = issue.get("assignee") or {}
-                assignee_id = single.get("id")
-                assignee_name = single.get("name", "—")
-
-            closing_comment = None
-            closing_comment_id = None
-            if closed_dt:
-                for n in notes:
-                    if n.get("system"):
-                        continue
-                    note_dt = datetime.datetime.fromisoformat(n["created_at"].rstrip("Z"))
-                    if abs((note_dt - closed_dt).total_seconds()) < 1:
-                        closing_comment = n["body"].strip()
-                        closing_comment_id = n["id"]
-                        break
-
-            if closing_comment is None:
-                non_system = [n for n in notes if not n.get("system", False)]
-                if non_system and assignee_id and non_system[0]["author"]["id"] == assignee_id:
-                    closing_comment = non_system[0]["body"].strip()
-                    closing_comment_id = non_system[0]["id"]
-
-            lines = [
-                f"Обращение #{issue_iid} ({issue['state']}) <b>{issue['title']}</b> передано на приемку",
-                f"Исполнитель: {assignee_name}",
-                "",
-                "Пожалуйста, проверьте результаты по обращению — "
-                "если остались вопросы, верните на доработку, "
-                "если вопросов нет, нажмите кнопку «Принять».",
-            ]
-            if closing_comment:
-                lines += [
-                    "",
-                    "<b>Комментарий</b> исполнителя:",
-                    closing_comment
-                ]
-            detail_text = "\n".join(lines)
-
-            kb = InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text="Принять",    callback_data=f"ack:{project_id}:{issue_iid}"),
-                InlineKeyboardButton(text="Вернуть на доработку", callback_data=f"reopen:{project_id}:{issue_iid}")
-            ]])
+        if snap["state"] == "closed":
+            detail_text = closed_issue_text(snapshot_issue(snap), snap["closing_comment"]) + staleness_marker(snap)
+            kb = closed_issue_keyboard(project_id, issue_iid)
 
             await state.clear()
             await message.answer(detail_text, reply_markup=kb, parse_mode="HTML")
             return
 
-        raw_desc = issue.get('description') or ""
+        raw_desc = snap['description'] or ""
         sanitized = re.sub(r'<details>.*?</details>', "", raw_desc, flags=re.DOTALL | re.IGNORECASE)
         body_only = strip_metadata(sanitized) or "—"
 
-        all_notes = requests.get(f"{issue_url}/notes", headers=HEADERS).json()
-        user_notes = [n for n in all_notes if not n.get("system", False)]
-        user_notes.sort(key=lambda n: n["created_at"])
-        last_three = user_notes[-3:]
+        last_three = snap["recent_notes"][-3:]
         if last_three:
             comments = []
             for note in last_three:
                 dt = datetime.datetime.fromisoformat(note["created_at"].rstrip("Z"))
                 dt_str = dt.strftime("%d.%m.%Y %H:%M")
-                comments.append(f"<i>{note['author']['name']}</i>, {dt_str}\n{note['body']}")
+                comments.append(f"<i>{note['author']}</i>, {dt_str}\n{note['body']}")
             comments_text = "\n\n".join(comments)
         else:
             comments_text = "Комментариев нет."
 
-        in_progress = (f"<b>Текущее обращение #{issue_iid} ({issue['state']}) – {issue['title']}</b>\n\n"
+        in_progress = (f"<b>Текущее обращение #{issue_iid} ({snap['state']}) – {snap['title']}</b>\n\n"
                 f"{body_only}\n\n"
-                f"{comments_text}")
+                f"{comments_text}"
+                f"{staleness_marker(snap)}")
         kb = InlineKeyboardMarkup(inline_keyboard=[[
                     InlineKeyboardButton(text="Оставить комментарий", callback_data=f"comment:{project_id}:{issue_iid}")]])
         await state.clear()
@@ -591,42 +564,37 @@ async def issue_selected_callback(callback: types.CallbackQuery):
     _, project_id, issue_iid = callback.data.split(":")
     project_id, issue_iid = int(project_id), int(issue_iid)
 
-    user_db = get_user(callback.from_user.id, callback.message.chat.id)
+    user_db = await get_user(callback.from_user.id, callback.message.chat.id)
     if not user_db:
         await callback.message.answer("Пользователь не найден в базе данных.")
         await callback.answer()
         return
 
-    headers = HEADERS
-    issue_url = f"{GITLAB_HOST}/api/v4/projects/{project_id}/issues/{issue_iid}"
-    resp = requests.get(issue_url, headers=headers)
-    if resp.status_code != 200:
+    snap = await adb.get_issue_snapshot(project_id, issue_iid)
+    snap = await load_snapshot(snap or {"project_id": project_id, "issue_iid": issue_iid, "title": None})
+    if not snap:
         await callback.message.answer("Не удалось получить данные обращения.")
         await callback.answer()
         return
-    issue = resp.json()
 
-    raw_desc = issue.get('description') or ""
+    raw_desc = snap['description'] or ""
     sanitized_desc = re.sub(r'<details>.*?</details>', '', raw_desc, flags=re.DOTALL|re.IGNORECASE)
     body_only = strip_metadata(sanitized_desc) or "—"
 
     attachments = re.findall(r'\[([^\]]+)\]\((/uploads/[^\)]+)\)', raw_desc)
 
-    notes_url = f"{issue_url}/notes"
-    notes_resp = requests.get(notes_url, headers=headers)
     latest = "Комментариев нет."
-    if notes_resp.status_code == 200:
-        notes = sorted(notes_resp.json(), key=lambda n: n['created_at'], reverse=True)
-        if notes:
-            latest = notes[0].get('body', latest)
+    if snap["recent_notes"]:
+        latest = snap["recent_notes"][-1].get('body', latest)
 
     issue_text = (
-        f"<b>Обращение #{issue['iid']}</b>\n"
-        f"Название: {issue['title']}\n"
+        f"<b>Обращение #{snap['issue_iid']}</b>\n"
+        f"Название: {snap['title']}\n"
         f"Описание: {body_only}\n"
-        f"Статус: {issue['state']}\n"
-        f"Автор: {issue['author']['name']}\n"
+        f"Статус: {snap['state']}\n"
+        f"Автор: {snap['author_name']}\n"
         f"<b>Последний комментарий:</b>\n{latest}"
+        f"{staleness_marker(snap)}"
     )
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -640,16 +608,7 @@ async def issue_selected_callback(callback: types.CallbackQuery):
     await callback.message.answer(issue_text, reply_markup=keyboard, parse_mode='HTML')
 
     for label, path in attachments:
-        file_url = f"{GITLAB_HOST}{path}"
-        resp = requests.get(file_url, headers=HEADERS)
-        if resp.status_code == 200:
-            tg_file = BufferedInputFile(
-                resp.content,
-                filename=label)
-            await callback.message.answer_document(
-                document=tg_file,
-                caption=label)
-        else:
+        if not await relay.send_document(callback.message, project_id, label, path):
             await callback.message.answer(f"⚠️ Не удалось загрузить вложение {label}")
     await callback.answer()
 
@@ -660,7 +619,7 @@ async def comment_issue_callback(callback: types.CallbackQuery, state: FSMContex
     issue_iid = int(issue_iid)
     await state.update_data(project_id=project_id, issue_iid=issue_iid)
 
-    db.add_subscription(callback.from_user.id, project_id, issue_iid)
+    await adb.add_subscription(callback.from_user.id, project_id, issue_iid)
 
     await state.set_state(CommentIssue.enter_comment)
     await callback.message.answer("✍️ Введите комментарий к обращению:")
@@ -710,36 +669,14 @@ async def handle_media_group(message: types.Message, album: list[types.Message],
     await add_state_to_history(state, await state.get_state())
     data = await state.get_data()
     files = data.get('files', [])
-    for msg in album:
-        file = None
-        file_info = None
-        if msg.document:
-            file = msg.document
-            file_info = await bot.get_file(file.file_id)
-            file_type = "document"
-        elif msg.photo:
-            file = msg.photo[-1]
-            file_info = await bot.get_file(file.file_id)
-            file_type = "photo"
-
-        if file_info:
-            downloaded_file = await bot.download_file(file_info.file_path)
-            file_data = downloaded_file.read()
-
-            file_size = len(file_data)
-            if file_size > MAX_FILE_SIZE:
-                await msg.answer(
-                    f"Файл {file.file_name if file else 'Не найдено'} слишком большой (макс. {MAX_FILE_SIZE // 1024 // 1024} MB)")
-
-            if len(files) >= MAX_FILES:
-                await msg.answer(f"Максимум {MAX_FILES} файлов")
-
-            files.append({
-                'file_name': file.file_name if hasattr(file, 'file_name') else f"photo_{file.file_id}.jpg",
-                'file_data': file_data,
-                'mime_type': file.mime_type if hasattr(file, 'mime_type') else "image/jpeg"
-            })
-            await state.update_data(files=files)
+
+    stored, too_large, over_limit = await save_album_files(state, album, files)
+    _, rejected = await add_session_files(state, 'files', stored)
+    for name in too_large:
+        await message.answer(f"Файл {name} слишком большой (макс. {MAX_FILE_SIZE // 1024 // 1024} MB)")
+    if over_limit or rejected:
+        await message.answer(f"Максимум {MAX_FILES} файлов")
+
 @router.message(StateFilter(CreateIssue.add_files), F.document | F.photo)
 async def collect_files(message: types.Message, state: FSMContext):
     await add_state_to_history(state, await state.get_state())
@@ -755,19 +692,15 @@ async def collect_files(message: types.Message, state: FSMContext):
         file_info = await bot.get_file(file.file_id)
 
     if file_info:
-        downloaded_file = await bot.download_file(file_info.file_path)
-        file_data = downloaded_file.read()
-        file_size = len(file_data)
-        if file_size > MAX_FILE_SIZE:
-            await message.answer(f"Файл {file.file_name if file else 'Не найдено'} слишком большой (макс. {MAX_FILE_SIZE // 1024 // 1024} MB)")
         if len(files) >= MAX_FILES:
-            await message.answer(f"Максимум {MAX_FILES} файлов")
-        files.append({
-            'file_name': file.file_name if hasattr(file, 'file_name') else f"photo_{file.file_id}.jpg",
-            'file_data': file_data,
-            'mime_type': file.mime_type if hasattr(file, 'mime_type') else "image/jpeg"
-        })
-        await state.update_data(files=files)
+            return await message.answer(f"Максимум {MAX_FILES} файлов")
+        stored = await save_telegram_file(state, file)
+        if stored['size'] > MAX_FILE_SIZE:
+            blob_store.discard(state.key, stored['blob'])
+            return await message.answer(f"Файл {file_display_name(file)} слишком большой (макс. {MAX_FILE_SIZE // 1024 // 1024} MB)")
+        _, rejected = await add_session_files(state, 'files', [stored])
+        if rejected:
+            return await message.answer(f"Максимум {MAX_FILES} файлов")
 
     if message.text == 'Продолжить':
         send_or_cancel = ["Отправить", "Отменить"]
@@ -799,21 +732,26 @@ async def cmd_send_issue(message: types.Message, state: FSMContext):
     header = "\n\n".join(header_lines)
     body = data["issue_description"]
     full_descr = f"{header}\n\n{body}"
+
+    files = data.get("files", [])
+    markdowns = await upload_session_files(message, GITLAB_PROJECT_ID, files)
+    if markdowns:
+        full_descr += "\n\n<b>Прикреплённые файлы:</b>\n" + "\n".join(markdowns)
     params = {
         "title": data["issue_title"],
         "description": full_descr,
         "issue_type": "incident",
     }
-    gitlab_issue = create_gitlab_issue(GITLAB_PROJECT_ID, params)
+    gitlab_issue = await gitlab.create_issue(GITLAB_PROJECT_ID, params)
 
     if gitlab_issue:
         await message.reply(f"✅ Обращение зарегистрировано.")
-        db.create_tracked_issue(
+        await adb.create_tracked_issue(
             project_id=GITLAB_PROJECT_ID,
             issue_iid=gitlab_issue["iid"],
             telegram_chat_id=message.chat.id
         )
-        db.add_subscription(message.from_user.id, GITLAB_PROJECT_ID, gitlab_issue["iid"])
+        await adb.add_subscription(message.from_user.id, GITLAB_PROJECT_ID, gitlab_issue["iid"])
         try:
             await bot.send_message(
                 GROUP_CHAT_ID,
@@ -833,9 +771,8 @@ async def acknowledge_issue_callback(callback: types.CallbackQuery):
     _, project_id, issue_iid = callback.data.split(":")
     project_id, issue_iid = int(project_id), int(issue_iid)
 
-    issue_url = f"{GITLAB_HOST}/api/v4/projects/{project_id}/issues/{issue_iid}"
-    requests.put(issue_url, headers=HEADERS, json={"labels": ""})
-    db.delete_tracked_issue(project_id, issue_iid)
+    await gitlab.update_issue(project_id, issue_iid, {"labels": ""})
+    await adb.delete_tracked_issue(project_id, issue_iid)
 
     await callback.message.answer("✅ Обращение закрыто. Спасибо!", parse_mode="HTML")
     await callback.answer()
@@ -853,96 +790,42 @@ async def cmd_ready_to_send(message: types.Message, state: FSMContext):
         reply_markup=make_row_keyboard(["Отправить", "Отменить"]))
     await state.set_state(CreateIssue.send_issue)
 
-async def monitor_closed_issues():
-    logging.info("🚨 monitor_closed_issues has started")
-    while True:
-        for project_id, issue_iid, chat_id in db.get_unnotified_issues():
-            issue_url = f"{GITLAB_HOST}/api/v4/projects/{project_id}/issues/{issue_iid}"
-            r = requests.get(issue_url, headers=HEADERS)
-            if r.status_code != 200:
-                continue
-            issue = r.json()
-            if issue.get("state") != "closed":
-                continue
-
-            requests.put(issue_url, headers=HEADERS, json={"labels": "На проверке"})
-
-            closed_at = issue.get("closed_at")
-            closed_dt = None
-            if closed_at:
-                closed_dt = datetime.datetime.fromisoformat(closed_at.rstrip("Z"))
-
-            notes = requests.get(
-                f"{issue_url}/notes",
-                params={"order_by": "created_at", "sort": "desc"},
-                headers=HEADERS
-            ).json()
-
-            assignees = issue.get("assignees") or []
-            if assignees:
-                assignee = assignees[0]
-                assignee_id = assignee.get("id")
-                assignee_name = assignee.get("name", "—")
-            else:
-                single = issue.get("assignee") or {}
-                assignee_id = single.get("id")
-                assignee_name = single.get("name", "—")
-
-            closing_comment = None
-            closing_comment_id = None
-            if closed_dt:
-                for n in notes:
-                    if n.get("system"):
-                        continue
-                    note_dt = datetime.datetime.fromisoformat(n["created_at"].rstrip("Z"))
-                    if abs((note_dt - closed_dt).total_seconds()) < 1:
-                        closing_comment = n["body"].strip()
-                        closing_comment_id = n["id"]
-                        break
-
-            if closing_comment is None:
-                non_system = [n for n in notes if not n.get("system", False)]
-                if non_system and assignee_id and non_system[0]["author"]["id"] == assignee_id:
-                    closing_comment = non_system[0]["body"].strip()
-                    closing_comment_id = non_system[0]["id"]
-
-            lines = [
-                f"Обращение #{issue_iid} ({issue['state']}) <b>{issue['title']}</b> передано на приемку",
-                f"Исполнитель: {assignee_name}",
-                "",
-                "Пожалуйста, проверьте результаты по обращению — "
-                "если остались вопросы, верните на доработку, "
-                "если вопросов нет, нажмите кнопку «Принять».",]
-            if closing_comment:
-                lines += ["",
-                          "<b>Комментарий исполнителя:</b>",
-                          closing_comment]
-            detail_text = "\n".join(lines)
-
-            if closing_comment_id is not None:
-                db.update_last_note_id(project_id, issue_iid, closing_comment_id)
-
-            kb = InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text="Принять",    callback_data=f"ack:{project_id}:{issue_iid}"),
-                InlineKeyboardButton(text="Вернуть на доработку", callback_data=f"reopen:{project_id}:{issue_iid}")
-            ]])
-            await bot.send_message(chat_id, detail_text, parse_mode="HTML", reply_markup=kb)
-            db.mark_issue_notified(project_id, issue_iid)
-
-        await asyncio.sleep(60)
-
 async def monitor_auto_ack():
+    delivery_priority.set(Priority.BULK)
     while True:
         cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=24)
-        rows = db.get_notified_unacked_older_than(cutoff)
+        rows = await adb.get_notified_unacked_older_than(cutoff)
+        # Все просроченные задачи удаляются одной транзакцией, сообщения - только по реально удалённым
+        keys = [(project_id, issue_iid) for project_id, issue_iid, _ in rows]
+        deleted = set(await adb.bulk_delete_tracked_issues(keys))
         for project_id, issue_iid, chat_id in rows:
-            db.delete_tracked_issue(project_id, issue_iid)
+            if (project_id, issue_iid) not in deleted:
+                continue
             await bot.send_message(
                 chat_id,
                 "⏰ Вы не ответили в течение 24 часов — задача закрывается автоматически.",
                 parse_mode="HTML")
+        try:
+            orphans = await adb.delete_orphan_issue_snapshots()
+            if orphans:
+                logging.info(f"Удалено снимков неотслеживаемых задач: {orphans}")
+        except Exception as e:
+            logging.warning(f"Не удалось удалить снимки неотслеживаемых задач: {e}")
         await asyncio.sleep(3600)
 
+async def monitor_sessions():
+    while True:
+        await asyncio.sleep(600)
+        expired = blob_store.expire()
+        if expired:
+            logging.info(f"Освобождены файлы {expired} неактивных сессий: {blob_store.stats()}")
+        try:
+            deleted = await fsm_storage.cleanup()
+            if deleted:
+                logging.info(f"Удалено брошенных сессий FSM: {deleted}")
+        except Exception as e:
+            logging.warning(f"Не удалось очистить сессии FSM: {e}")
+
 async def prompt_issue_creation(message: Message, state: FSMContext):
     await state.clear()
     await message.reply(
@@ -966,89 +849,54 @@ async def go_back_to_description(message: Message, state: FSMContext):
         reply_markup=make_row_keyboard([], add_back_button=True))
     await state.set_state(CreateIssue.select_description)
 
-async def monitor_new_comments():
-    logging.info("🚨 monitor_new_comments has started")
-    link_regex = re.compile(r'\[([^\]]+)\]\((/uploads/[^)]+)\)')
-    img_regex  = re.compile(r'!\[[^\]]*\]\((/uploads/[^)]+)\)')
-    while True:
-        for project_id, issue_iid, chat_id, last_known, _ in db.get_all_tracked_issues():
-            r_issue = requests.get(
-                f"{GITLAB_HOST}/api/v4/projects/{project_id}/issues/{issue_iid}",
-                headers=HEADERS)
-
-            if r_issue.status_code != 200:
-                continue
-            issue = r_issue.json()
-
-            if issue.get("state") == "closed":
-                continue
-
-            r_notes = requests.get(
-                f"{GITLAB_HOST}/api/v4/projects/{project_id}/issues/{issue_iid}/notes",
-                params={"order_by": "created_at", "sort": "asc"},
-                headers=HEADERS)
-
-            if r_notes.status_code != 200:
-                continue
-            notes = [n for n in r_notes.json() if not n.get("system", False)]
-
-            new_notes = [n for n in notes if n["id"] > last_known]
-            if not new_notes:
-                continue
+def snapshot_issue(snap: dict) -> dict:
+    """Снимок задачи в виде ответа GitLab, который ожидают функции из messages"""
+    return {
+        "iid": snap["issue_iid"],
+        "state": snap["state"],
+        "title": snap["title"],
+        "assignee": {"id": snap["assignee_id"], "name": snap["assignee_name"] or "—"},
+    }
 
-            new_last = max(n["id"] for n in new_notes)
-            db.update_last_note_id(project_id, issue_iid, new_last)
-
-            owner_id = issue["author"]["id"]
-            recips = set(db.get_subscribers(project_id, issue_iid))
-            owner = db.get_user_by_gitlab_id(owner_id)
-            if owner:
-                recips.add(owner["telegram_chat_id"])
-
-            for note in new_notes:
-                if note["author"]["id"] == owner_id:
-                    continue
-
-                body = link_regex.sub("", note["body"])
-                body = img_regex.sub("", body).strip()
-
-                caption = (
-                    f"🔔 <b>Новый комментарий</b> по обращению #{issue_iid}\n\n"
-                    f"{body}\n\n"
-                    f"<i>Автор: {note['author']['name']}</i>"
-                )
-
-                attachments = link_regex.findall(note["body"])
-                attachments += [
-                    (alt or os.path.basename(p), p)
-                    for p in img_regex.findall(note["body"])
-                    for alt, p in [("", p)]
-                ]
-
-                if attachments:
-                    media = []
-                    for idx, (label, path) in enumerate(attachments):
-                        resp = requests.get(f"{GITLAB_HOST}{path}", headers=HEADERS, stream=True)
-                        if resp.status_code != 200:
-                            continue
-                        fn = label or os.path.basename(path).lstrip("_")
-                        buf = BufferedInputFile(resp.content, filename=fn)
-                        if resp.headers.get("Content-Type", "").startswith("image/"):
-                            item = InputMediaPhoto(media=buf,
-                                                   caption=caption if idx == 0 else fn,
-                                                   parse_mode="HTML")
-                        else:
-                            item = InputMediaDocument(media=buf,
-                                                      caption=caption if idx == 0 else fn,
-                                                      parse_mode="HTML")
-                        media.append(item)
-                    for cid in recips:
-                        await bot.send_media_group(cid, media)
-                else:
-                    for cid in recips:
-                        await bot.send_message(cid, caption, parse_mode="HTML")
-
-        await asyncio.sleep(60)
+def snapshot_is_stale(snap: dict) -> bool:
+    checked_at = snap.get("checked_at")
+    if checked_at is None:
+        return True
+    age = datetime.datetime.now(datetime.timezone.utc) - checked_at
+    return age.total_seconds() > ISSUE_SNAPSHOT_STALE_AFTER
+
+def staleness_marker(snap: dict) -> str:
+    if not snapshot_is_stale(snap):
+        return ""
+    return f"\n\n<i>⚠️ Данные на {snap['checked_at'].astimezone():%d.%m.%Y %H:%M}, могли устареть</i>"
+
+# Фоновые обновления снимков по (project_id, issue_iid): ссылка держит задачу до завершения,
+# а повторные нажатия по той же задаче не запускают второе обновление
+snapshot_refreshes: dict[tuple[int, int], asyncio.Task] = {}
+
+async def refresh_snapshot_quietly(project_id: int, issue_iid: int):
+    try:
+        await sweep.refresh_snapshot(project_id, issue_iid)
+    except Exception as e:
+        logging.warning(f"Не удалось обновить снимок задачи {project_id}#{issue_iid}: {e}")
+
+async def load_snapshot(snap: dict) -> dict | None:
+    """
+    Задача, которую обход ещё не сохранил, читается из GitLab сразу.
+    Устаревший снимок показывается как есть и обновляется в фоне
+    :return: снимок или None, если его нет и GitLab не ответил
+    """
+    if snap["title"] is None:
+        try:
+            return await sweep.refresh_snapshot(snap["project_id"], snap["issue_iid"])
+        except Exception as e:
+            logging.warning(f"Не удалось получить задачу {snap['project_id']}#{snap['issue_iid']}: {e}")
+            return None
+    key = (snap["project_id"], snap["issue_iid"])
+    if snapshot_is_stale(snap) and key not in snapshot_refreshes:
+        task = snapshot_refreshes[key] = asyncio.create_task(refresh_snapshot_quietly(*key))
+        task.add_done_callback(lambda _: snapshot_refreshes.pop(key, None))
+    return snap
 
 def strip_metadata(description: str) -> str:
     prefixes = ("Никнейм:", "ID:", "Имя:", "Телефон:")
@@ -1062,35 +910,6 @@ def strip_metadata(description: str) -> str:
         break
     return "\n".join(lines[i:]).strip()
 
-async def monitor_assignment_changes():
-    logging.info("🚨 monitor_assignment_changes has started")
-    while True:
-        for project_id, issue_iid, chat_id, _last_note, last_assignee in db.get_all_tracked_issues():
-            resp = requests.get(
-                f"{GITLAB_HOST}/api/v4/projects/{project_id}/issues/{issue_iid}",
-                headers=HEADERS)
-            if resp.status_code != 200:
-                continue
-
-            issue = resp.json()
-            assignees = issue.get("assignees") or []
-            curr_id = assignees[0]["id"] if assignees else None
-
-            if curr_id is not None and curr_id != last_assignee:
-                if last_assignee is None:
-                    text = "🔔 По обращению назначен исполнитель"
-                else:
-                    text = "🔔 Назначен новый исполнитель"
-
-                try:
-                    await bot.send_message(chat_id, text, parse_mode="HTML")
-                except Exception as e:
-                    logging.warning(f"Failed to notify assignment change: {e}")
-
-                db.update_last_assignee_id(project_id, issue_iid, curr_id)
-
-        await asyncio.sleep(60)
-
 @router.message(StateFilter(CreateGitlabUser.create_gitlab_user))
 async def cmd_create_gitlab_user(message: types.Message, state: FSMContext):
     await add_state_to_history(state, await state.get_state())
@@ -1107,11 +926,13 @@ async def cmd_set_gitlab_login(message: types.Message, state: FSMContext):
     await state.clear()
 
 async def add_state_to_history(state: FSMContext, new_state: str):
-    data = await state.get_data()
-    history = data.get("state_history", [])
-    if not history or history[-1] != new_state:
-        history.append(new_state)
-        await state.update_data(state_history=history)
+    # update_data перезаписывает данные целиком, поэтому идёт под той же блокировкой, что и список файлов
+    async with session_lock(state):
+        data = await state.get_data()
+        history = data.get("state_history", [])
+        if not history or history[-1] != new_state:
+            history.append(new_state)
+            await state.update_data(state_history=history)
 
 
 @router.my_chat_member()
@@ -1119,7 +940,7 @@ async def on_added_to_group(my_chat_member: ChatMemberUpdated):
     if my_chat_member.new_chat_member.status in ("member", "administrator"):
         chat = my_chat_member.chat
         # record chat.id in your groups table
-        db.register_group(chat.id)
+        await adb.register_group(chat.id)
         await bot.send_message(
             chat.id,
             "👋 Thanks for adding me! I’m now watching this group for GitLab issues."
@@ -1130,17 +951,31 @@ async def tracer(message: types.Message):
     logging.info(f"⏳ got {message.text!r} in chat {message.chat.id} ({message.chat.type})")
 
 async def main():
-    asyncio.create_task(monitor_closed_issues())
-    asyncio.create_task(monitor_new_comments())
+    asyncio.create_task(sweep.run_forever(listener=db_listener))
     await dp.start_polling(bot)
 
 @dp.startup()
 async def on_startup():
+    logging.info("🔌 on_startup: applying DB migrations")
+    await adb.migrate()
     logging.info("🔌 on_startup: scheduling background tasks")
-    asyncio.create_task(monitor_closed_issues())
-    asyncio.create_task(monitor_new_comments())
-    asyncio.create_task(monitor_assignment_changes())
+    asyncio.create_task(sweep.run_forever(listener=db_listener))
     asyncio.create_task(monitor_auto_ack())
+    asyncio.create_task(monitor_sessions())
+    provisioning = (lambda: provision_known_users(user_directory, gitlab, adb)) \
+        if USER_DIRECTORY_CONFIG['provisioning_enabled'] else None
+    asyncio.create_task(user_directory.run_forever(on_refresh=provisioning))
+
+@dp.shutdown()
+async def on_shutdown():
+    logging.info(f"🔌 on_shutdown: closing DB pool {db.pool_stats()}")
+    db_listener.close()
+    await sweep.release()
+    await outbox.close()
+    await gitlab.close()
+    # Несохранённые изменения сессий записываются в БД до закрытия пула
+    await dp.storage.close()
+    adb.close()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,106 @@
+import datetime
+import os
+import re
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+LINK_REGEX = re.compile(r'\[([^\]]+)\]\((/uploads/[^)]+)\)')
+IMG_REGEX = re.compile(r'!\[[^\]]*\]\((/uploads/[^)]+)\)')
+
+
+def parse_gitlab_datetime(value: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(value.rstrip("Z"))
+
+
+def get_assignee(issue: dict):
+    """
+    :param issue: задача GitLab
+    :return: кортеж (id, имя) первого исполнителя
+    """
+    assignees = issue.get("assignees") or []
+    if assignees:
+        assignee = assignees[0]
+    else:
+        assignee = issue.get("assignee") or {}
+    return assignee.get("id"), assignee.get("name", "—")
+
+
+def find_closing_comment(issue: dict, notes: list):
+    """
+    Ищет комментарий, оставленный исполнителем при закрытии задачи
+    :param issue: задача GitLab
+    :param notes: комментарии задачи, отсортированные от новых к старым
+    :return: кортеж (текст, id) или (None, None)
+    """
+    closed_at = issue.get("closed_at")
+    closed_dt = parse_gitlab_datetime(closed_at) if closed_at else None
+
+    if closed_dt:
+        for n in notes:
+            if n.get("system"):
+                continue
+            note_dt = parse_gitlab_datetime(n["created_at"])
+            if abs((note_dt - closed_dt).total_seconds()) < 1:
+                return n["body"].strip(), n["id"]
+
+    assignee_id, _ = get_assignee(issue)
+    non_system = [n for n in notes if not n.get("system", False)]
+    if non_system and assignee_id and non_system[0]["author"]["id"] == assignee_id:
+        return non_system[0]["body"].strip(), non_system[0]["id"]
+    return None, None
+
+
+def closed_issue_text(issue: dict, closing_comment: str | None) -> str:
+    _, assignee_name = get_assignee(issue)
+    lines = [
+        f"Обращение #{issue['iid']} ({issue['state']}) <b>{issue['title']}</b> передано на приемку",
+        f"Исполнитель: {assignee_name}",
+        "",
+        "Пожалуйста, проверьте результаты по обращению — "
+        "если остались вопросы, верните на доработку, "
+        "если вопросов нет, нажмите кнопку «Принять».",
+    ]
+    if closing_comment:
+        lines += ["",
+                  "<b>Комментарий исполнителя:</b>",
+                  closing_comment]
+    return "\n".join(lines)
+
+
+def closed_issue_keyboard(project_id: int, issue_iid: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="Принять", callback_data=f"ack:{project_id}:{issue_iid}"),
+        InlineKeyboardButton(text="Вернуть на доработку", callback_data=f"reopen:{project_id}:{issue_iid}")
+    ]])
+
+
+def new_note_caption(issue_iid: int, note: dict) -> str:
+    body = LINK_REGEX.sub("", note["body"])
+    body = IMG_REGEX.sub("", body).strip()
+    return (
+        f"🔔 <b>Новый комментарий</b> по обращению #{issue_iid}\n\n"
+        f"{body}\n\n"
+        f"<i>Автор: {note['author']['name']}</i>"
+    )
+
+
+def note_attachments(body: str) -> list[tuple[str, str]]:
+    """
+    :param body: текст комментария GitLab
+    :return: список пар (подпись, путь /uploads/...) вложений комментария
+    """
+    attachments = LINK_REGEX.findall(body)
+    attachments += [(os.path.basename(p), p) for p in IMG_REGEX.findall(body)]
+    return attachments
+
+
+def assignee_changed_text(previous_assignee_id: int | None) -> str:
+    if previous_assignee_id is None:
+        return "🔔 По обращению назначен исполнитель"
+    return "🔔 Назначен новый исполнитель"
+
+
+def labels_changed_text(issue_iid: int, labels: list[str]) -> str:
+    if labels:
+        return f"🏷 Метки обращения #{issue_iid} изменены: {', '.join(labels)}"
+    return f"🏷 С обращения #{issue_iid} сняты все метки"
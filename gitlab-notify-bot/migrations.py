@@ -0,0 +1,118 @@
+"""
+Версионированные миграции схемы БД.
+Каждая миграция - кортеж (версия, описание, SQL). Применённые версии
+записываются в таблицу schema_migrations, поэтому миграции выполняются один раз.
+"""
+
+MIGRATIONS = [
+    (1, "Базовые таблицы users, tracked_issues, issue_subscriptions", """
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id BIGINT PRIMARY KEY,
+            gitlab_id INTEGER NOT NULL,
+            gitlab_login TEXT NOT NULL,
+            gitlab_token TEXT NOT NULL,
+            telegram_chat_id BIGINT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS tracked_issues (
+            project_id    INTEGER    NOT NULL,
+            issue_iid     INTEGER    NOT NULL,
+            telegram_chat_id BIGINT  NOT NULL,
+            notified      BOOLEAN    NOT NULL DEFAULT FALSE,
+            last_note_id  INTEGER    NOT NULL DEFAULT 0,
+            last_assignee_id INTEGER,
+            PRIMARY KEY   (project_id, issue_iid)
+        );
+
+        CREATE TABLE IF NOT EXISTS issue_subscriptions (
+            id SERIAL PRIMARY KEY,
+            user_telegram_id BIGINT NOT NULL,
+            project_id INTEGER NOT NULL,
+            issue_iid INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_telegram_id, project_id, issue_iid)
+        );
+    """),
+    (2, "Столбец tracked_issues.notified_at для mark_issue_notified", """
+        ALTER TABLE tracked_issues ADD COLUMN IF NOT EXISTS notified_at TIMESTAMP;
+    """),
+    (3, "Индексы для запросов мониторов и поиска пользователей", """
+        CREATE INDEX IF NOT EXISTS tracked_issues_notified_idx
+            ON tracked_issues (notified, notified_at);
+        CREATE INDEX IF NOT EXISTS tracked_issues_chat_idx
+            ON tracked_issues (telegram_chat_id);
+        CREATE INDEX IF NOT EXISTS users_gitlab_id_idx
+            ON users (gitlab_id);
+        CREATE INDEX IF NOT EXISTS issue_subscriptions_issue_idx
+            ON issue_subscriptions (project_id, issue_iid);
+    """),
+    (4, "Столбец tracked_issues.last_labels для детектора меток", """
+        ALTER TABLE tracked_issues ADD COLUMN IF NOT EXISTS last_labels TEXT[];
+    """),
+    (5, "Отметки updated_at по проектам для инкрементального опроса", """
+        CREATE TABLE IF NOT EXISTS project_watermarks (
+            project_id    INTEGER     PRIMARY KEY,
+            updated_after TIMESTAMPTZ NOT NULL,
+            stored_at     TIMESTAMP   NOT NULL DEFAULT NOW()
+        );
+    """),
+    (6, "Кэш file_id Telegram для вложений GitLab", """
+        CREATE TABLE IF NOT EXISTS telegram_file_cache (
+            project_id   INTEGER   NOT NULL,
+            upload_path  TEXT      NOT NULL,
+            media_type   TEXT      NOT NULL,
+            content_hash TEXT      NOT NULL,
+            file_id      TEXT      NOT NULL,
+            created_at   TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (project_id, upload_path, media_type)
+        );
+        CREATE INDEX IF NOT EXISTS telegram_file_cache_hash_idx
+            ON telegram_file_cache (content_hash, media_type);
+    """),
+    (7, "Состояния FSM бота для нескольких экземпляров", """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            storage_key TEXT      PRIMARY KEY,
+            state       TEXT,
+            data        JSONB     NOT NULL DEFAULT '{}',
+            version     INTEGER   NOT NULL DEFAULT 1,
+            updated_at  TIMESTAMP NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS fsm_states_updated_idx
+            ON fsm_states (updated_at);
+    """),
+    (8, "Аренда отслеживаемых задач экземплярами бота", """
+        ALTER TABLE tracked_issues ADD COLUMN IF NOT EXISTS lease_owner TEXT;
+        ALTER TABLE tracked_issues ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+        CREATE INDEX IF NOT EXISTS tracked_issues_lease_idx
+            ON tracked_issues (lease_owner, lease_expires_at);
+
+        CREATE TABLE IF NOT EXISTS sweep_instances (
+            instance_id  TEXT        PRIMARY KEY,
+            heartbeat_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+
+        -- Отметка опроса теперь своя у каждого экземпляра: он видит только арендованные задачи
+        DELETE FROM project_watermarks;
+        ALTER TABLE project_watermarks ADD COLUMN IF NOT EXISTS owner TEXT NOT NULL DEFAULT '';
+        ALTER TABLE project_watermarks DROP CONSTRAINT IF EXISTS project_watermarks_pkey;
+        ALTER TABLE project_watermarks ADD PRIMARY KEY (project_id, owner);
+    """),
+    (9, "Снимки отслеживаемых задач для показа без запросов к GitLab", """
+        CREATE TABLE IF NOT EXISTS issue_snapshots (
+            project_id      INTEGER     NOT NULL,
+            issue_iid       INTEGER     NOT NULL,
+            title           TEXT        NOT NULL,
+            state           TEXT        NOT NULL,
+            description     TEXT,
+            author_name     TEXT,
+            assignee_id     INTEGER,
+            assignee_name   TEXT,
+            closed_at       TIMESTAMPTZ,
+            closing_comment TEXT,
+            recent_notes    JSONB       NOT NULL DEFAULT '[]',
+            refreshed_at    TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            checked_at      TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (project_id, issue_iid)
+        );
+    """),
+]
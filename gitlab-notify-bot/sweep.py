@@ -0,0 +1,628 @@
+import asyncio
+import datetime
+import logging
+import os
+import socket
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from aiogram import Bot
+
+from async_db import AsyncDatabase, DatabaseListener
+from attachments import AttachmentRelay
+from db import TRACKED_ISSUES_CHANNEL
+from delivery import Priority, delivery_priority
+from gitlab_client import GitLabClient
+from messages import (
+    find_closing_comment, closed_issue_text, closed_issue_keyboard, new_note_caption,
+    note_attachments, assignee_changed_text, labels_changed_text, get_assignee
+)
+
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", "60"))
+SWEEP_CONCURRENCY = int(os.getenv("SWEEP_CONCURRENCY", "10"))
+SWEEP_DEADLINE = float(os.getenv("SWEEP_DEADLINE", "50"))
+# Сколько циклов подряд повторяется задача, на которой упал детектор
+SWEEP_MAX_RETRIES = int(os.getenv("SWEEP_MAX_RETRIES", "5"))
+# При включённых вебхуках GitLab опрос нужен только как редкая сверка
+WEBHOOK_ENABLED = os.getenv("GITLAB_WEBHOOK_ENABLED", "false").lower() in ("1", "true", "yes")
+RECONCILE_INTERVAL = float(os.getenv("SWEEP_RECONCILE_INTERVAL", "600"))
+# Имя экземпляра бота в арендах tracked_issues и отметках опроса. Должно быть уникальным среди запущенных копий
+# и не меняться при перезапуске, иначе после рестарта теряется отметка и задачи перечитываются целиком.
+# По умолчанию имя хоста; несколько копий на одном хосте должны задать INSTANCE_ID явно
+INSTANCE_ID = os.getenv("INSTANCE_ID") or socket.gethostname()
+# Сколько секунд хранятся отметка и запись экземпляра, не появлявшегося в обходе
+SWEEP_INSTANCE_RETENTION = float(os.getenv("SWEEP_INSTANCE_RETENTION", str(7 * 24 * 3600)))
+# Срок аренды задач; по умолчанию три интервала обхода, чтобы аренда не истекала между циклами
+SWEEP_LEASE_TTL = float(os.getenv("SWEEP_LEASE_TTL", "0")) or None
+# События tracked_issues, по которым задача обрабатывается сразу
+IMMEDIATE_EVENTS = ("created", "unnotified", "changed")
+# Сколько последних комментариев хранится в снимке задачи
+ISSUE_SNAPSHOT_NOTES = int(os.getenv("ISSUE_SNAPSHOT_NOTES", "3"))
+# Сколько задач с изменённым состоянием копится до записи в БД, не дожидаясь конца цикла
+SWEEP_STATE_BATCH_SIZE = int(os.getenv("SWEEP_STATE_BATCH_SIZE", "200"))
+
+
+def parse_updated_at(value: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def format_updated_at(value: datetime.datetime) -> str:
+    return value.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def build_issue_snapshot(project_id: int, issue: dict, notes: list, keep_notes: int = ISSUE_SNAPSHOT_NOTES) -> dict:
+    """
+    :param notes: комментарии задачи от старых к новым
+    :return: словарь со столбцами issue_snapshots
+    """
+    closing_comment = None
+    if issue.get("state") == "closed":
+        closing_comment, _ = find_closing_comment(issue, list(reversed(notes)))
+    assignee_id, assignee_name = get_assignee(issue)
+    user_notes = [n for n in notes if not n.get("system", False)]
+    return {
+        "project_id": project_id,
+        "issue_iid": issue["iid"],
+        "title": issue["title"],
+        "state": issue["state"],
+        "description": issue.get("description"),
+        "author_name": (issue.get("author") or {}).get("name"),
+        "assignee_id": assignee_id,
+        "assignee_name": assignee_name,
+        "closed_at": issue.get("closed_at"),
+        "closing_comment": closing_comment,
+        "recent_notes": [
+            {"id": n["id"], "author": n["author"]["name"], "created_at": n["created_at"], "body": n["body"]}
+            for n in user_notes[-keep_notes:]
+        ] if keep_notes else [],
+    }
+
+
+@dataclass
+class TrackedIssue:
+    """Строка tracked_issues с сохранённым состоянием задачи."""
+    project_id: int
+    issue_iid: int
+    telegram_chat_id: int
+    last_note_id: int
+    last_assignee_id: int | None
+    notified: bool
+    last_labels: list[str] | None = None
+    # Задача только что перешла от другого экземпляра или была свободна
+    acquired: bool = False
+
+
+class StateBatch:
+    """
+    Изменения состояния tracked_issues, накопленные детекторами за цикл обхода.
+    Записываются в БД одной транзакцией с массовыми UPDATE: в конце цикла, при накоплении max_pending задач
+    и сразу после уведомления о закрытии, на которое пользователь может ответить.
+    """
+
+    def __init__(self, db: AsyncDatabase, max_pending: int = SWEEP_STATE_BATCH_SIZE):
+        self.db = db
+        self.max_pending = max_pending
+        # (project_id, issue_iid) -> {столбец: значение}; для notified значение True
+        self._pending: dict[tuple[int, int], dict] = {}
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def record(self, row: TrackedIssue, **changes):
+        """Запоминает новые значения столбцов задачи, например record(row, last_note_id=10)."""
+        self._pending.setdefault((row.project_id, row.issue_iid), {}).update(changes)
+        if len(self._pending) >= self.max_pending:
+            await self.flush()
+
+    async def forget(self, project_id: int, issue_iid: int, *columns: str):
+        """
+        Отбрасывает накопленные значения столбцов задачи перед их прямой записью в БД (например, при возврате
+        на доработку), чтобы пакетная запись в конце цикла не вернула устаревшие значения.
+        Дожидается уже идущей пакетной записи, поэтому прямая запись после вызова окажется последней.
+        """
+        async with self._lock:
+            changes = self._pending.get((project_id, issue_iid))
+            if changes is None:
+                return
+            for column in columns:
+                changes.pop(column, None)
+            if not changes:
+                del self._pending[(project_id, issue_iid)]
+
+    def _write(self, pending: dict[tuple[int, int], dict]):
+        columns = {"last_note_id": [], "last_assignee_id": [], "last_labels": []}
+        notified = []
+        for (project_id, issue_iid), changes in pending.items():
+            for column, rows in columns.items():
+                if column in changes:
+                    rows.append((project_id, issue_iid, changes[column]))
+            if changes.get("notified"):
+                notified.append((project_id, issue_iid))
+        database = self.db.database
+        with database.connection():
+            database.bulk_update_last_note_id(columns["last_note_id"])
+            database.bulk_update_last_assignee_id(columns["last_assignee_id"])
+            database.bulk_update_last_labels(columns["last_labels"])
+            database.bulk_mark_issues_notified(notified)
+
+    async def flush(self):
+        """Записывает накопленные изменения; при ошибке они остаются до следующей записи."""
+        async with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            try:
+                await self.db.run(self._write, pending)
+            except Exception:
+                # Изменения, сделанные во время записи, новее возвращаемых
+                for key, changes in pending.items():
+                    self._pending[key] = {**changes, **self._pending.get(key, {})}
+                raise
+            logging.debug(f"Состояние {len(pending)} задач записано в БД")
+
+
+@dataclass
+class SweepContext:
+    bot: Bot
+    db: AsyncDatabase
+    gitlab: GitLabClient
+    relay: AttachmentRelay
+    # Создаётся IssueSweep, если не передан явно
+    state: StateBatch | None = None
+
+
+@dataclass
+class IssueSnapshot:
+    """
+    Состояние задачи за один проход: задача скачивается один раз,
+    комментарии - только если они понадобились какому-либо детектору, и только новее last_note_id
+    (плюс страница последних комментариев для поиска комментария при закрытии и снимка).
+    """
+    row: TrackedIssue
+    issue: dict
+    gitlab: GitLabClient
+    _notes: list | None = field(default=None, repr=False)
+    _notes_loaded: bool = field(default=False, repr=False)
+
+    async def get_notes(self) -> list | None:
+        """
+        :return: последние комментарии задачи от старых к новым, включая все новее last_note_id,
+                 или None, если GitLab не ответил
+        """
+        if not self._notes_loaded:
+            self._notes = await self.gitlab.get_notes_since(
+                self.row.project_id, self.row.issue_iid, self.row.last_note_id)
+            self._notes_loaded = True
+        return self._notes
+
+
+class ChangeDetector:
+    """Базовый детектор изменений. Получает снимок задачи и сам отправляет уведомления."""
+    name = "base"
+
+    async def detect(self, snapshot: IssueSnapshot, ctx: SweepContext):
+        raise NotImplementedError
+
+
+class ClosedIssueDetector(ChangeDetector):
+    """Задача закрыта исполнителем - передаём её автору на приёмку."""
+    name = "closed"
+
+    async def detect(self, snapshot: IssueSnapshot, ctx: SweepContext):
+        row, issue = snapshot.row, snapshot.issue
+        if row.notified or issue.get("state") != "closed":
+            return
+
+        if await ctx.gitlab.update_issue(row.project_id, row.issue_iid, {"labels": "На проверке"}):
+            # Метку ставит сам бот, уведомлять о ней детектору меток не нужно.
+            # Словарь задачи может лежать в кэше ответов GitLab, поэтому заменяем его копией
+            row.last_labels = ["На проверке"]
+            issue = snapshot.issue = {**issue, "labels": row.last_labels}
+            await ctx.state.record(row, last_labels=row.last_labels)
+
+        notes = await snapshot.get_notes() or []
+        closing_comment, closing_comment_id = find_closing_comment(issue, list(reversed(notes)))
+        if closing_comment_id is not None:
+            await ctx.state.record(row, last_note_id=closing_comment_id)
+            row.last_note_id = closing_comment_id
+
+        await ctx.bot.send_message(
+            row.telegram_chat_id,
+            closed_issue_text(issue, closing_comment),
+            parse_mode="HTML",
+            reply_markup=closed_issue_keyboard(row.project_id, row.issue_iid))
+        await ctx.state.record(row, notified=True)
+        row.notified = True
+        # Автор может сразу вернуть задачу на доработку: его ответ не должен перезаписываться этим циклом
+        await ctx.state.flush()
+
+
+class NewNoteDetector(ChangeDetector):
+    """Новые комментарии к открытой задаче рассылаются подписчикам и автору."""
+    name = "new_note"
+
+    async def detect(self, snapshot: IssueSnapshot, ctx: SweepContext):
+        row, issue = snapshot.row, snapshot.issue
+        if issue.get("state") == "closed":
+            return
+
+        notes = await snapshot.get_notes()
+        if notes is None:
+            return
+        new_notes = [n for n in notes if not n.get("system", False) and n["id"] > row.last_note_id]
+        if not new_notes:
+            return
+
+        owner_id = issue["author"]["id"]
+        recips = set(await ctx.db.get_subscribers(row.project_id, row.issue_iid))
+        owner = await ctx.db.get_user_by_gitlab_id(owner_id)
+        if owner:
+            recips.add(owner["telegram_chat_id"])
+
+        # last_note_id сдвигается только после того, как комментарий получил хотя бы один получатель:
+        # если задачу отменит дедлайн цикла или не удастся ни одна отправка, неразосланные комментарии
+        # повторятся в следующем цикле, а не потеряются
+        for note in sorted(new_notes, key=lambda n: n["id"]):
+            if note["author"]["id"] != owner_id:
+                caption = new_note_caption(row.issue_iid, note)
+                if not await self._notify(ctx, row.project_id, list(recips), note, caption):
+                    raise RuntimeError(f"комментарий {note['id']} не доставлен ни одному получателю")
+            await ctx.state.record(row, last_note_id=note["id"])
+            row.last_note_id = note["id"]
+
+    @staticmethod
+    async def _notify(ctx: SweepContext, project_id: int, recips: list, note: dict, caption: str) -> bool:
+        """
+        :return: True, если комментарий получил хотя бы один получатель или получателей нет
+        """
+        if not recips:
+            return True
+        attachments = note_attachments(note["body"])
+        prepared = await ctx.relay.prepare_many(project_id, attachments) if attachments else []
+        delivered = 0
+        try:
+            if prepared:
+                # Первая отправка загружает новые файлы и сохраняет их file_id, остальные получатели
+                # получают альбом уже по file_id без повторного скачивания и загрузки
+                first, *rest = recips
+                try:
+                    await ctx.relay.send_media_group(ctx.bot, first, prepared, caption)
+                    delivered += 1
+                except Exception as e:
+                    logging.warning(f"Failed to notify {first} about note {note['id']}: {e}")
+                sends = [ctx.relay.send_media_group(ctx.bot, cid, prepared, caption) for cid in rest]
+                targets = rest
+            else:
+                sends = [ctx.bot.send_message(cid, caption, parse_mode="HTML") for cid in recips]
+                targets = recips
+            # Отправки встают в очередь доставки одновременно, ошибка одного получателя не мешает остальным
+            for cid, result in zip(targets, await asyncio.gather(*sends, return_exceptions=True)):
+                if isinstance(result, Exception):
+                    logging.warning(f"Failed to notify {cid} about note {note['id']}: {result}")
+                else:
+                    delivered += 1
+            return delivered > 0
+        finally:
+            # Временные файлы вложений удаляются сразу после рассылки
+            ctx.relay.release(prepared)
+
+
+class AssigneeChangeDetector(ChangeDetector):
+    """Сообщает автору о назначении нового исполнителя."""
+    name = "assignee"
+
+    async def detect(self, snapshot: IssueSnapshot, ctx: SweepContext):
+        row, issue = snapshot.row, snapshot.issue
+        assignees = issue.get("assignees") or []
+        curr_id = assignees[0]["id"] if assignees else None
+        if curr_id is None or curr_id == row.last_assignee_id:
+            return
+
+        try:
+            await ctx.bot.send_message(row.telegram_chat_id, assignee_changed_text(row.last_assignee_id),
+                                       parse_mode="HTML")
+        except Exception as e:
+            logging.warning(f"Failed to notify assignment change: {e}")
+
+        await ctx.state.record(row, last_assignee_id=curr_id)
+        row.last_assignee_id = curr_id
+
+
+class LabelChangeDetector(ChangeDetector):
+    """Сообщает автору об изменении меток. При первом проходе метки только запоминаются."""
+    name = "labels"
+
+    async def detect(self, snapshot: IssueSnapshot, ctx: SweepContext):
+        row, issue = snapshot.row, snapshot.issue
+        labels = sorted(issue.get("labels") or [])
+        if row.last_labels is not None and sorted(row.last_labels) == labels:
+            return
+
+        if row.last_labels is not None:
+            try:
+                await ctx.bot.send_message(row.telegram_chat_id, labels_changed_text(row.issue_iid, labels),
+                                           parse_mode="HTML")
+            except Exception as e:
+                logging.warning(f"Failed to notify label change: {e}")
+
+        await ctx.state.record(row, last_labels=labels)
+        row.last_labels = labels
+
+
+class SnapshotRecorder(ChangeDetector):
+    """Сохраняет снимок задачи, из которого бот показывает обращения без запросов к GitLab."""
+    name = "snapshot"
+
+    async def detect(self, snapshot: IssueSnapshot, ctx: SweepContext):
+        notes = await snapshot.get_notes()
+        if notes is None:
+            return
+        await ctx.db.save_issue_snapshot(build_issue_snapshot(snapshot.row.project_id, snapshot.issue, notes))
+
+
+def default_detectors() -> list[ChangeDetector]:
+    # Порядок важен: закрытие обновляет last_note_id и метки до остальных детекторов,
+    # снимок сохраняется последним, уже с метками, поставленными ботом
+    return [ClosedIssueDetector(), NewNoteDetector(), AssigneeChangeDetector(), LabelChangeDetector(),
+            SnapshotRecorder()]
+
+
+class IssueSweep:
+    """
+    Единый обход отслеживаемых задач: каждая задача скачивается из GitLab
+    один раз за цикл и передаётся по очереди всем детекторам изменений.
+    Несколько экземпляров бота делят задачи арендой строк tracked_issues: каждый обходит только свою долю,
+    задачи остановленного или упавшего экземпляра забирают остальные после истечения аренды.
+    """
+
+    def __init__(self, ctx: SweepContext, detectors: list[ChangeDetector] | None = None,
+                 concurrency: int = SWEEP_CONCURRENCY, deadline: float = SWEEP_DEADLINE,
+                 instance_id: str = INSTANCE_ID, lease_ttl: float | None = SWEEP_LEASE_TTL,
+                 instance_retention: float = SWEEP_INSTANCE_RETENTION, max_retries: int = SWEEP_MAX_RETRIES):
+        self.ctx = ctx
+        if ctx.state is None:
+            ctx.state = StateBatch(ctx.db)
+        self.detectors = detectors if detectors is not None else default_detectors()
+        self.concurrency = concurrency
+        self.deadline = deadline
+        self.instance_id = instance_id
+        self.lease_ttl = lease_ttl or 3 * SWEEP_INTERVAL
+        self.instance_retention = instance_retention
+        self.max_retries = max_retries
+        # (project_id, issue_iid) -> число неудачных обработок подряд; такие задачи запрашиваются по iid
+        # в следующих циклах, хотя отметка проекта уже ушла дальше них
+        self._retry: dict[tuple[int, int], int] = {}
+
+    async def process(self, row: TrackedIssue, issue: dict) -> bool:
+        """
+        Передаёт задачу всем детекторам; ошибка одного детектора не мешает остальным
+        :return: False, если хотя бы один детектор упал и задачу нужно обработать повторно
+        """
+        snapshot = IssueSnapshot(row=row, issue=issue, gitlab=self.ctx.gitlab)
+        ok = True
+        for detector in self.detectors:
+            try:
+                await detector.detect(snapshot, self.ctx)
+            except Exception as e:
+                ok = False
+                logging.exception(f"Детектор {detector.name} упал на задаче "
+                                  f"{row.project_id}#{row.issue_iid}: {e}")
+        return ok
+
+    async def process_issue(self, project_id: int, issue_iid: int, handoff: bool = False) -> bool:
+        """
+        Обрабатывает одну задачу вне цикла, например по событию вебхука
+        :param handoff: если задачу арендовал другой экземпляр, попросить его обработать её через NOTIFY;
+                        свободная задача арендуется только на время обработки, её продолжит обходить цикл опроса
+        :return: False, если задача не отслеживается, занята другим экземпляром, не получена из GitLab
+                 или детектор завершился ошибкой
+        """
+        state = await self.ctx.db.claim_tracked_issue(project_id, issue_iid, self.instance_id, self.lease_ttl)
+        if state is None:
+            if handoff:
+                await self.ctx.db.request_issue_processing(project_id, issue_iid)
+            return False
+        try:
+            issue = await self.ctx.gitlab.get_issue(project_id, issue_iid)
+            if not issue:
+                return False
+            return await self.process(TrackedIssue(**state), issue)
+        finally:
+            await self.ctx.state.flush()
+            if handoff and state["acquired"]:
+                await self.ctx.db.release_tracked_issue(project_id, issue_iid, self.instance_id)
+
+    async def refresh_snapshot(self, project_id: int, issue_iid: int) -> dict | None:
+        """
+        Перечитывает задачу из GitLab и сохраняет её снимок, не запуская детекторы
+        :return: снимок или None, если GitLab не ответил
+        """
+        issue = await self.ctx.gitlab.get_issue(project_id, issue_iid)
+        if not issue:
+            return None
+        # Снимку нужны только последние комментарии: первой страницы достаточно
+        notes = await self.ctx.gitlab.get_notes(project_id, issue_iid,
+                                                params={"order_by": "created_at", "sort": "desc"})
+        if notes is None:
+            return None
+        # Ответ может лежать в кэше GitLab-клиента, поэтому не разворачиваем его на месте
+        notes = notes[::-1]
+        snapshot = build_issue_snapshot(project_id, issue, notes)
+        await self.ctx.db.save_issue_snapshot(snapshot)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return {**snapshot, "refreshed_at": now, "checked_at": now}
+
+    async def _process_limited(self, semaphore: asyncio.Semaphore, row: TrackedIssue, issue: dict) -> bool:
+        async with semaphore:
+            return await self.process(row, issue)
+
+    async def _fetch_changed(self, project_id: int, rows: list[TrackedIssue],
+                             watermark: datetime.datetime | None):
+        """
+        Получает только задачи проекта, изменившиеся после отметки watermark.
+        Новые строки (ещё ни разу не обойдённые), строки, полученные от другого экземпляра,
+        задачи, ожидающие повтора, и проект без отметки запрашиваются целиком по iid.
+        :return: кортеж (список пар (строка, задача), новая отметка) или None, если GitLab не ответил
+        """
+        by_iid = {row.issue_iid: row for row in rows}
+        issues = {}
+        if watermark is None:
+            forced = list(by_iid)
+        else:
+            forced = [row.issue_iid for row in rows
+                      if row.last_labels is None or row.acquired or (project_id, row.issue_iid) in self._retry]
+            updated = await self.ctx.gitlab.list_issues(project_id, [
+                ("updated_after", format_updated_at(watermark)),
+                ("order_by", "updated_at"),
+                ("sort", "asc"),
+            ])
+            if updated is None:
+                return None
+            # updated_after включает границу: задачи ровно на отметке уже обработаны в прошлом цикле
+            issues.update((issue["iid"], issue) for issue in updated
+                          if issue["iid"] in by_iid and parse_updated_at(issue["updated_at"]) > watermark)
+
+        if forced:
+            found = await self.ctx.gitlab.get_issues_by_iids(project_id, forced)
+            if found is None:
+                return None
+            issues.update(found)
+
+        new_watermark = watermark
+        for issue in issues.values():
+            updated_at = parse_updated_at(issue["updated_at"])
+            if new_watermark is None or updated_at > new_watermark:
+                new_watermark = updated_at
+        if watermark is not None:
+            # Задачи вне отслеживаемых тоже сдвигают отметку: повторно их запрашивать незачем
+            for issue in updated:
+                updated_at = parse_updated_at(issue["updated_at"])
+                if updated_at > new_watermark:
+                    new_watermark = updated_at
+        return [(by_iid[iid], issue) for iid, issue in issues.items() if iid in by_iid], new_watermark
+
+    async def run_cycle(self):
+        """
+        Один проход: задачи скачиваются по проектам, затем обрабатываются параллельно
+        (не более self.concurrency одновременно). Всё, что не успело до self.deadline, отменяется
+        и будет подхвачено следующим циклом: отметка такого проекта не сдвигается.
+        Задачи с упавшим детектором отметку не держат, они повторяются по iid не больше max_retries циклов.
+        """
+        started = time.monotonic()
+        deadline = started + self.deadline
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        by_project = defaultdict(list)
+        for row in await self.ctx.db.claim_tracked_issues(self.instance_id, self.lease_ttl, self.instance_retention):
+            by_project[row["project_id"]].append(TrackedIssue(**row))
+        # Задачи, ушедшие к другому экземпляру или переставшие отслеживаться, больше не повторяем
+        claimed = {(project_id, row.issue_iid) for project_id, rows in by_project.items() for row in rows}
+        self._retry = {key: attempts for key, attempts in self._retry.items() if key in claimed}
+        watermarks = await self.ctx.db.get_project_watermarks(self.instance_id)
+
+        async def fetch(project_id):
+            async with semaphore:
+                return await self._fetch_changed(project_id, by_project[project_id], watermarks.get(project_id))
+
+        project_ids = list(by_project)
+        fetched = await asyncio.gather(*(fetch(project_id) for project_id in project_ids))
+
+        tasks = {}
+        new_watermarks = {}
+        for project_id, changed in zip(project_ids, fetched):
+            if changed is None:
+                logging.warning(f"Не удалось получить задачи проекта {project_id}, пропускаем до следующего цикла")
+                continue
+            pairs, new_watermarks[project_id] = changed
+            for row, issue in pairs:
+                task = asyncio.create_task(self._process_limited(semaphore, row, issue))
+                tasks[task] = (project_id, row.issue_iid)
+
+        done, pending = set(), set()
+        try:
+            if tasks:
+                done, pending = await asyncio.wait(tasks, timeout=max(deadline - time.monotonic(), 0))
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            # Состояние пишется до отметок проектов: отметка не должна опережать обработанные задачи
+            await self.ctx.state.flush()
+
+        incomplete = {tasks[task][0] for task in pending}
+        failed = 0
+        for task in done:
+            key = tasks[task]
+            if task.exception() is None and task.result():
+                self._retry.pop(key, None)
+                continue
+            failed += 1
+            if task.exception() is not None:
+                logging.error(f"Обработка задачи {key[0]}#{key[1]} завершилась ошибкой: {task.exception()!r}")
+            # Отметка проекта сдвигается и без этой задачи, чтобы одна сбойная задача не заставляла
+            # перечитывать весь проект; сама задача повторяется по iid не больше max_retries циклов
+            attempts = self._retry.get(key, 0) + 1
+            if attempts > self.max_retries:
+                self._retry.pop(key, None)
+                logging.error(f"Задача {key[0]}#{key[1]} не обработана за {self.max_retries} повторов, "
+                              f"ждём её следующего изменения в GitLab")
+            else:
+                self._retry[key] = attempts
+
+        for project_id, new_watermark in new_watermarks.items():
+            if project_id in incomplete:
+                continue
+            if new_watermark is not None and new_watermark != watermarks.get(project_id):
+                await self.ctx.db.set_project_watermark(project_id, self.instance_id, new_watermark)
+            # Неизменившиеся задачи проекта тоже проверены этим циклом
+            await self.ctx.db.touch_issue_snapshots(project_id, [row.issue_iid for row in by_project[project_id]])
+
+        logging.info(f"Цикл обхода задач за {time.monotonic() - started:.1f} с: "
+                     f"обработано {len(done) - failed}, с ошибкой {failed}, пропущено по таймауту {len(pending)}")
+
+    async def run_forever(self, interval: float | None = None, listener: DatabaseListener | None = None):
+        """
+        Полный цикл выполняется раз в interval секунд. Между циклами ждём уведомлений БД:
+        новые и возвращённые на доработку задачи обрабатываются сразу, без ожидания цикла.
+        """
+        if interval is None:
+            interval = RECONCILE_INTERVAL if WEBHOOK_ENABLED else SWEEP_INTERVAL
+        if SWEEP_LEASE_TTL is None:
+            self.lease_ttl = 3 * interval
+        # Уведомления обхода идут в очередь доставки после интерактивных ответов
+        delivery_priority.set(Priority.BULK)
+        logging.info(f"🚨 issue sweep has started, interval {interval} s, instance {self.instance_id}")
+        next_cycle = time.monotonic()
+        while True:
+            if time.monotonic() >= next_cycle:
+                try:
+                    await self.run_cycle()
+                    logging.debug(f"Кэш ответов GitLab: {self.ctx.gitlab.cache.snapshot_stats()}")
+                except Exception as e:
+                    logging.exception(f"Цикл обхода задач завершился с ошибкой: {e}")
+                next_cycle = time.monotonic() + interval
+
+            timeout = max(next_cycle - time.monotonic(), 0)
+            if listener is None:
+                await asyncio.sleep(timeout)
+                continue
+
+            events = await listener.wait(timeout)
+            keys = {
+                (payload["project_id"], payload["issue_iid"])
+                for channel, payload in events
+                if channel == TRACKED_ISSUES_CHANNEL and payload.get("event") in IMMEDIATE_EVENTS
+            }
+            for project_id, issue_iid in keys:
+                try:
+                    await self.process_issue(project_id, issue_iid)
+                except Exception as e:
+                    logging.exception(f"Ошибка обработки задачи {project_id}#{issue_iid} по уведомлению БД: {e}")
+
+    async def release(self):
+        """Отпускает арендованные задачи, чтобы другие экземпляры забрали их без ожидания истечения аренды."""
+        await self.ctx.state.flush()
+        released = await self.ctx.db.release_tracked_issues(self.instance_id, self.lease_ttl)
+        logging.info(f"Экземпляр {self.instance_id} отпустил {released} задач")
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable
+
+from dotenv import load_dotenv
+
+from async_db import AsyncDatabase
+from gitlab_client import GitLabClient
+
+load_dotenv()
+USER_DIRECTORY_CONFIG = {
+    "refresh_interval": float(os.getenv("USER_DIRECTORY_REFRESH_INTERVAL", "600")),
+    "full_refresh_interval": float(os.getenv("USER_DIRECTORY_FULL_REFRESH_INTERVAL", str(24 * 3600))),
+    # Сколько секунд помнить, что Telegram id нет среди пользователей GitLab
+    "negative_ttl": float(os.getenv("USER_DIRECTORY_NEGATIVE_TTL", "300")),
+    "provisioning_enabled": os.getenv("USER_PROVISIONING_ENABLED", "false").lower() in ("1", "true", "yes"),
+    "provisioning_concurrency": int(os.getenv("USER_PROVISIONING_CONCURRENCY", "4")),
+}
+# Поле профиля GitLab, в котором хранится Telegram id пользователя
+TELEGRAM_ID_FIELD = "skype"
+# advisory-блокировка, под которой пользователей заранее заводит только один экземпляр бота
+USER_PROVISIONING_LOCK_ID = 7_311_002
+
+
+def telegram_key(value) -> str | None:
+    value = str(value or "").strip()
+    return value or None
+
+
+class GitLabUserDirectory:
+    """
+    Справочник пользователей GitLab с индексом по Telegram id (поле skype профиля).
+    Полностью загружается раз в full_refresh_interval, в промежутках дочитываются только пользователи,
+    изменённые после последней загрузки. Неизвестные Telegram id запоминаются на negative_ttl секунд,
+    чтобы нажатия незнакомых пользователей не вызывали обновление справочника.
+    """
+
+    def __init__(self, gitlab: GitLabClient,
+                 refresh_interval: float = USER_DIRECTORY_CONFIG['refresh_interval'],
+                 full_refresh_interval: float = USER_DIRECTORY_CONFIG['full_refresh_interval'],
+                 negative_ttl: float = USER_DIRECTORY_CONFIG['negative_ttl']):
+        self.gitlab = gitlab
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self.negative_ttl = negative_ttl
+        self._by_telegram: dict[str, dict] = {}
+        self._telegram_by_id: dict[int, str] = {}
+        self._negative: dict[str, float] = {}
+        self._updated_after: str | None = None
+        self._full_refreshed_at: float | None = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._full_refreshed_at is not None
+
+    def _index(self, user: dict):
+        key = telegram_key(user.get(TELEGRAM_ID_FIELD))
+        previous = self._telegram_by_id.pop(user["id"], None)
+        if previous is not None and self._by_telegram.get(previous, {}).get("id") == user["id"]:
+            del self._by_telegram[previous]
+        if key is None or user.get("state") == "blocked":
+            return
+        self._by_telegram[key] = user
+        self._telegram_by_id[user["id"]] = key
+        self._negative.pop(key, None)
+
+    def _advance(self, users: list):
+        stamps = [user["updated_at"] for user in users if user.get("updated_at")]
+        if stamps:
+            newest = max(stamps)
+            if self._updated_after is None or newest > self._updated_after:
+                self._updated_after = newest
+
+    async def refresh(self, full: bool = False) -> bool:
+        """
+        Загружает справочник целиком или дочитывает изменённых пользователей
+        :return: False, если GitLab не ответил
+        """
+        async with self._lock:
+            full = full or not self.loaded or self._updated_after is None
+            if full:
+                users = await self.gitlab.get_users({"order_by": "id", "sort": "asc"})
+            else:
+                # Страницы от последних изменённых, чтение прекращается на уже известных изменениях
+                since = self._updated_after
+                users = await self.gitlab.get_users(
+                    {"order_by": "updated_at", "sort": "desc"},
+                    until=lambda page: any((user.get("updated_at") or "") <= since for user in page))
+            if users is None:
+                logging.warning("Не удалось обновить справочник пользователей GitLab")
+                return False
+
+            if full:
+                self._by_telegram.clear()
+                self._telegram_by_id.clear()
+                self._negative.clear()
+                self._full_refreshed_at = time.monotonic()
+            for user in users:
+                self._index(user)
+            self._advance(users)
+            logging.info(f"Справочник пользователей GitLab обновлён ({'полностью' if full else 'изменения'}): "
+                         f"получено {len(users)}, с Telegram id {len(self._by_telegram)}")
+            return True
+
+    async def find(self, telegram_id: int) -> dict | None:
+        """
+        :return: пользователь GitLab с этим Telegram id или None
+        """
+        key = telegram_key(telegram_id)
+        if not self.loaded:
+            await self.refresh(full=True)
+        user = self._by_telegram.get(key)
+        if user is not None:
+            return user
+
+        expires = self._negative.get(key)
+        if expires is not None and expires > time.monotonic():
+            return None
+        # Пользователь мог появиться в GitLab после последнего обновления
+        await self.refresh()
+        user = self._by_telegram.get(key)
+        if user is None:
+            self._negative[key] = time.monotonic() + self.negative_ttl
+        return user
+
+    def telegram_users(self) -> dict[str, dict]:
+        return dict(self._by_telegram)
+
+    async def run_forever(self, on_refresh: Callable[[], Awaitable] | None = None):
+        """
+        Фоновое обновление справочника
+        :param on_refresh: вызывается после каждого успешного обновления, например для заведения пользователей
+        """
+        while True:
+            full = (self._full_refreshed_at is None
+                    or time.monotonic() - self._full_refreshed_at >= self.full_refresh_interval)
+            try:
+                if await self.refresh(full=full) and on_refresh is not None:
+                    await on_refresh()
+            except Exception as e:
+                logging.exception(f"Ошибка обновления справочника пользователей GitLab: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+
+async def provision_user(gitlab: GitLabClient, db: AsyncDatabase, gitlab_user: dict, telegram_id: int,
+                         telegram_chat_id: int):
+    """
+    Создаёт пользователю токен GitLab и заводит его в таблице users.
+    Если запись не создана (в том числе её уже завёл параллельный запрос), токен отзывается,
+    чтобы у пользователя не копились неиспользуемые токены
+    :return: запись пользователя или None
+    """
+    params = {
+        'user_id': gitlab_user['id'],
+        'name': 'GitLab & Telegram Bot',
+        'scopes[]': 'api'
+    }
+    user_token_gitlab = await gitlab.create_personal_access_token(params)
+    if not user_token_gitlab:
+        logging.warning(
+            f"Для пользователя {telegram_id} не создан токен Gitlab и создание пользователя в БД прекращено")
+        return None
+
+    user_db = await db.create_user(telegram_id=telegram_id, gitlab_id=gitlab_user['id'],
+                                   gitlab_login=gitlab_user['username'],
+                                   gitlab_token=user_token_gitlab['token'],
+                                   telegram_chat_id=telegram_chat_id)
+    if user_db:
+        logging.info(f"Пользователь {telegram_id} создан в БД {user_db}")
+        return user_db
+
+    logging.warning(f"Пользователь {telegram_id} не создан в БД, отзываем созданный для него токен")
+    if not await gitlab.revoke_personal_access_token(user_token_gitlab['id']):
+        logging.warning(f"Не удалось отозвать токен {user_token_gitlab['id']} пользователя {telegram_id}")
+    # Запись мог создать параллельный запрос: тогда отдаём её
+    return await db.get_user_by_telegram_id(telegram_id)
+
+
+async def provision_known_users(directory: GitLabUserDirectory, gitlab: GitLabClient, db: AsyncDatabase,
+                                concurrency: int = USER_DIRECTORY_CONFIG['provisioning_concurrency']) -> int:
+    """
+    Заранее заводит в таблице users всех пользователей GitLab с Telegram id, которых там ещё нет.
+    Личный чат с ботом имеет тот же id, что и пользователь, поэтому telegram_chat_id = telegram_id.
+    Выполняется только одним экземпляром бота: остальные пропускают проход, пока держится блокировка
+    :return: число заведённых пользователей
+    """
+    lock = await db.try_advisory_lock(USER_PROVISIONING_LOCK_ID)
+    if lock is None:
+        logging.debug("Пользователей заводит другой экземпляр бота, пропускаем")
+        return 0
+    try:
+        return await _provision_missing(directory, gitlab, db, concurrency)
+    finally:
+        await db.release_advisory_lock(lock, USER_PROVISIONING_LOCK_ID)
+
+
+async def _provision_missing(directory: GitLabUserDirectory, gitlab: GitLabClient, db: AsyncDatabase,
+                             concurrency: int) -> int:
+    known = await db.get_known_telegram_ids()
+    pending = []
+    for key, user in directory.telegram_users().items():
+        if not key.isdigit() or int(key) in known:
+            continue
+        pending.append((int(key), user))
+    if not pending:
+        return 0
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def provision(telegram_id: int, user: dict):
+        async with semaphore:
+            return await provision_user(gitlab, db, user, telegram_id, telegram_id)
+
+    results = await asyncio.gather(*(provision(telegram_id, user) for telegram_id, user in pending),
+                                   return_exceptions=True)
+    created = sum(1 for result in results if result and not isinstance(result, Exception))
+    logging.info(f"Заранее заведено пользователей: {created} из {len(pending)}")
+    return created